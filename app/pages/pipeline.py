@@ -9,6 +9,8 @@ import pandas as pd
 import time
 from msi_visual.app.utils.pipeline import create_pipeline
 from msi_visual.app.utils.extraction import get_extraction
+from msi_visual.normalization import total_ion_count
+from msi_visual.preprocessing import tissue_mask
 import wx
 
 app = wx.App()
@@ -86,8 +88,13 @@ with pipeline_tab:
 
         if regions:
             for index, path in enumerate(regions):
-                img = normalization(np.load(path))
-                
+                if normalization is total_ion_count:
+                    # The tissue mask comes out of the normalization pass
+                    img, mask = total_ion_count(np.load(path), return_mask=True)
+                else:
+                    img = normalization(np.load(path))
+                    mask = tissue_mask(img)
+
                 for method_index, method in enumerate(models):
                     try:
                         method._trained = False
@@ -97,7 +104,7 @@ with pipeline_tab:
                             if not isinstance(result, list):
                                 result = [result]
                             for visualization_index, visualization in enumerate(result):
-                                visualization[img.max(axis=-1) == 0] = 0
+                                visualization[mask == 0] = 0
                                 if len(result) > 1:
                                     name = str(index) + "_" + str(method).replace(' ', '').replace(':', '_') + str(visualization_index) + '.png'
                                 else:
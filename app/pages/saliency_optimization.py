@@ -30,6 +30,21 @@ def save_gif(images, path):
     pil_images[0].save(fp=path, format='GIF', append_images=pil_images[1 : ],
             save_all=True, duration=200, loop=0)
 
+def label_frame(frame, epoch):
+    font = cv2.FONT_HERSHEY_SIMPLEX
+    bottomLeftCornerOfText = (5, 20)
+    fontScale = 0.5
+    fontColor = (255, 255, 255)
+    thickness = 1
+    lineType = 1
+    return cv2.putText(frame.copy(), f"Epoch: {epoch}",
+                       bottomLeftCornerOfText,
+                       font,
+                       fontScale,
+                       fontColor,
+                       thickness,
+                       lineType)
+
 def save_data(path=None):
     folder = "saliency_optimization"
     os.makedirs(folder, exist_ok=True)
@@ -72,6 +87,7 @@ with st.sidebar:
 
 
 epochs = st.number_input("Number of epochs", min_value=1, value=200, step=1)
+render_every = st.number_input("Show the visualization every N epochs", min_value=1, value=10, step=1)
 number_of_reference_points = st.number_input("Number of reference points", min_value=50, value=500, step=1)
 regularization = float(st.text_input("Regularization strength", value="0.01"))
 input_normalization = st.radio(
@@ -79,7 +95,8 @@ input_normalization = st.radio(
         'tic', 'spatial_tic'], index=0, key="norm", horizontal=1, captions=[
         "Total ION Count", "Total ION Count + Spatial"])
 
-settings_str = str(epochs) + str(number_of_reference_points) + str(regularization) + str(input_normalization)
+settings_str = str(epochs) + str(number_of_reference_points) + str(regularization) + str(input_normalization) + \
+    str(render_every)
 
 if st.button("Run"):
     for path in regions:
@@ -99,31 +116,16 @@ if st.button("Run"):
                 else:
                     img = spatial_total_ion_count(img)
 
-                with st.spinner(text=f"Initializing ranking dataset.."):
-                    opt = SaliencyOptimization(number_of_reference_points, regularization)
-                    opt.set_image(img)
+                opt = SaliencyOptimization(number_of_points=number_of_reference_points,
+                                           regularization_strength=regularization,
+                                           num_epochs=epochs)
                 placeholder = st.empty()
                 epoch_images = []
-                for epoch in range(epochs):
-                    with st.spinner(text=f"Epoch {epoch}.."):
-                        result = opt.compute_epoch()
-
-                        result_for_gif = result.copy()
-                        font = cv2.FONT_HERSHEY_SIMPLEX
-                        bottomLeftCornerOfText = (5, 20)
-                        fontScale = 0.5
-                        fontColor = (255, 255, 255)
-                        thickness = 1
-                        lineType = 1
-                        result_for_gif = cv2.putText(result_for_gif, f"Epoch: {epoch}",
-                                            bottomLeftCornerOfText,
-                                            font,
-                                            fontScale,
-                                            fontColor,
-                                            thickness,
-                                            lineType)
+                # Only every render_every-th epoch is rendered, the other epochs only optimize.
+                with st.spinner(text=f"Optimizing {epochs} epochs.."):
+                    for epoch, result in opt.predict_iter(img, every=render_every):
+                        result_for_gif = label_frame(result, epoch)
                         epoch_images.append(result_for_gif)
-
                         placeholder.image(result_for_gif)
                 metrics = MSIVisualizationMetrics(img, result, num_samples=3000).get_metrics()
                 st.write(metrics)
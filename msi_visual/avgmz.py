@@ -3,17 +3,16 @@ import cmapy
 from PIL import Image
 import numpy as np
 from msi_visual.utils import normalize_image_grayscale, image_histogram_equalization
+from msi_visual.spectral_moments import spectral_moments
 
 
 class AvgMZVisualization:
-    def __init__(self):
-        pass
+    def __init__(self, moment='mean'):
+        # One of spectral_moments.MOMENTS: mean, std, skewness or entropy
+        self.moment = moment
 
     def predict(self, img):
-        processed_img = img / img.sum(axis=-1)[:, :, None]
-        mz = np.arange(processed_img.shape[-1])
-        mz = mz[None, None, :]
-        self.avgmz = np.mean((processed_img * mz), axis=-1)
+        self.avgmz = spectral_moments(img, entropy=self.moment == 'entropy')[self.moment]
         return self.avgmz
 
     def get_subsegmentation(self, img, roi_mask, avgmz,
@@ -3,22 +3,22 @@ import cmapy
 from PIL import Image
 import numpy as np
 from msi_visual.utils import normalize_image_grayscale, image_histogram_equalization
+from msi_visual.spectral_moments import spectral_moments
 
 
 class SegmentationAvgMZVisualization:
-    def __init__(self, segmentation_model):
+    def __init__(self, segmentation_model, moment='raw_mean'):
+        """
+        moment: one of spectral_moments.MOMENTS. By default the mean of intensity x bin index over the bins,
+                without the TIC normalization.
+        """
         self.segmentation_model = segmentation_model
         self.k = self.segmentation_model.k
+        self.moment = moment
 
     def predict(self, img):
-        if img.dtype != np.float32:
-            img = np.float32(img)
-
         self.segmentation = self.segmentation_model.predict(img)
-
-        mz = np.arange(img.shape[-1])
-        mz = mz[None, None, :]
-        avgmz = (img * mz).mean(axis=-1)
+        avgmz = spectral_moments(img, entropy=self.moment == 'entropy')[self.moment]
         return self.segmentation, avgmz
 
     def get_subsegmentation(
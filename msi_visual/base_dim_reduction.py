@@ -1,9 +1,16 @@
 import numpy as np
 import joblib
 from msi_visual.utils import normalize
+from msi_visual.preprocessing import preprocess_pixels
+from msi_visual.memory import map_rows
+from msi_visual.landmarks import sample_landmarks, extend_embedding
+from msi_visual.sparse import stack_rows, to_dense
 
 
 class BaseDimReduction:
+    # Models that take CSR pixel matrices. The others get SparseCube pixels densified.
+    accepts_sparse = False
+
     def __init__(self, model, start_bin=0, end_bin=None):
         self.k = 3
         self.model = model
@@ -16,20 +23,21 @@ class BaseDimReduction:
         if self.end_bin is None:
             self.end_bin = images[0].shape[-1]
 
-        vector = np.concatenate([img[:, :, self.start_bin:self.end_bin].reshape(
-            -1, images[0][:, :, self.start_bin:self.end_bin].shape[-1]) for img in images], axis=0)
-        vector = vector.reshape((-1, vector.shape[-1]))
-        self.model.fit(vector)
+        vector = stack_rows([preprocess_pixels(img, self.start_bin, self.end_bin)[0]
+                             for img in images])
+        self.model.fit(self.model_input(vector))
         self._trained = True
 
 
     def predict(self, img):
-        vector = img[:, :, self.start_bin:self.end_bin].reshape(
-            (-1, img.shape[-1]))
-        result = self.model.transform(vector)
+        vector, _ = preprocess_pixels(img, self.start_bin, self.end_bin)
+        result = map_rows(lambda rows: self.model.transform(self.model_input(rows)), vector)
         result = result.reshape(img.shape[0], img.shape[1], result.shape[-1])
         return np.uint8(255 * normalize(result))
 
+    def model_input(self, vector):
+        return vector if self.accepts_sparse else to_dense(vector)
+
     def __call__(self, img):
         if not self._trained:
             self.fit([img])
@@ -39,16 +47,32 @@ class BaseDimReduction:
         joblib.dump(self, path)
 
 class BaseDimReductionWithoutFit(BaseDimReduction):
-    def __init__(self, model, name):
-        super().__init__(model=model)
+    def __init__(self, model, name, landmarks=None, n_neighbors=10, start_bin=0, end_bin=None):
+        """
+        landmarks: if set, the model is fitted only on this many coreset sampled tissue pixels,
+                   and the other pixels are placed by their n_neighbors nearest landmarks.
+                   This makes the O(N^2) manifold methods usable on full slides.
+        """
+        super().__init__(model=model, start_bin=start_bin, end_bin=end_bin)
         self.name = name
+        self.landmarks = landmarks
+        self.n_neighbors = n_neighbors
 
     def __repr__(self):
         return self.name
         
+    def fit_transform(self, vector):
+        return self.model.fit_transform(vector)
+
     def __call__(self, img):
-        vector = img.reshape((-1, img.shape[-1]))
-        result = self.model.fit_transform(vector)
+        vector, mask = preprocess_pixels(img, self.start_bin, self.end_bin)
+        if self.landmarks is not None and self.landmarks < vector.shape[0]:
+            indices = sample_landmarks(vector, self.landmarks, mask.reshape(-1))
+            landmarks = to_dense(vector[indices])
+            embedding = self.fit_transform(landmarks)
+            result = extend_embedding(vector, landmarks, embedding, self.n_neighbors, indices)
+        else:
+            result = self.fit_transform(self.model_input(vector))
         result = result.reshape(img.shape[0], img.shape[1], result.shape[-1])
         return np.uint8(255 * normalize(result))
 
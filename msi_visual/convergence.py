@@ -0,0 +1,67 @@
+import numpy as np
+
+
+class ConvergenceMonitor:
+    """Early stopping for the optimization based visualizations.
+
+    An epoch improves when its loss is lower than the best loss so far by more than tol (relative).
+    The optimization has converged after patience epochs in a row without an improvement.
+
+    Args:
+        tol: relative improvement threshold.
+        patience: number of epochs without an improvement before stopping.
+        min_epochs: never stop before this many epochs.
+        validation_pixels: if set, monitor a held out metric instead of the training loss:
+            the rank loss between this many random tissue pixels and validation_points other reference points,
+            with hard ranks. Those pairs are not part of the training loss.
+        validation_points: number of held out reference points.
+    """
+
+    def __init__(self, tol=1e-3, patience=10, min_epochs=0, validation_pixels=None, validation_points=100):
+        self.tol = tol
+        self.patience = patience
+        self.min_epochs = min_epochs
+        self.validation_pixels = validation_pixels
+        self.validation_points = validation_points
+        self.reset()
+
+    def __repr__(self):
+        return f"ConvergenceMonitor tol={self.tol} patience={self.patience} validation_pixels={self.validation_pixels}"
+
+    def reset(self):
+        self.history = []
+        self.best = None
+        self.epochs_without_improvement = 0
+
+    def update(self, loss):
+        """Records the loss of an epoch. Returns True when the optimization should stop."""
+        loss = float(loss)
+        self.history.append(loss)
+        if self.best is None or loss < self.best - self.tol * abs(self.best):
+            self.best = loss
+            self.epochs_without_improvement = 0
+        else:
+            self.epochs_without_improvement += 1
+        return len(self.history) >= self.min_epochs and self.epochs_without_improvement >= self.patience
+
+
+def sample_validation_pairs(mask, exclude, number_of_pixels, number_of_points, seed=0):
+    """Random held out pixels and reference points among the tissue pixels, without the training reference points.
+
+    Args:
+        mask: bool ndarray [N] of the tissue pixels.
+        exclude: the rows of the training reference points.
+    Returns:
+        pixel_rows, reference_rows: int64 ndarrays.
+    """
+    rng = np.random.default_rng(seed)
+    candidates = np.setdiff1d(np.flatnonzero(mask), exclude)
+    reference_rows = rng.choice(candidates, min(number_of_points, len(candidates)), replace=False)
+    candidates = np.setdiff1d(candidates, reference_rows)
+    pixel_rows = rng.choice(candidates, min(number_of_pixels, len(candidates)), replace=False)
+    return pixel_rows, reference_rows
+
+
+def hard_ranks(distances):
+    """Rank of every column within its row, like distances.argsort().argsort()."""
+    return distances.argsort(dim=-1).argsort(dim=-1)
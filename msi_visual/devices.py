@@ -0,0 +1,22 @@
+import torch
+
+COMPUTE_DTYPES = {"float32": torch.float32, "bfloat16": torch.bfloat16}
+
+
+def get_device(device=None):
+    """torch.device from a name like 'cpu' or 'cuda:1'. None picks cuda when it is available, otherwise the cpu."""
+    if device is None:
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+    return torch.device(device)
+
+
+def get_compute_dtype(dtype="float32"):
+    if dtype not in COMPUTE_DTYPES:
+        raise Exception(f"{dtype} not supported as compute dtype, use one of {list(COMPUTE_DTYPES)}")
+    return COMPUTE_DTYPES[dtype]
+
+
+def set_num_threads(num_threads=None):
+    """Number of threads of the torch CPU kernels. None keeps the torch default."""
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
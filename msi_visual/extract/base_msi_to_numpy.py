@@ -4,6 +4,7 @@ from argparse import Namespace
 from typing import Optional
 import tqdm
 from abc import ABC, abstractmethod
+from msi_visual.memory import allocate, iter_chunks
 
 class BaseMSIToNumpy(ABC):
     def __init__(self,
@@ -92,9 +93,9 @@ class BaseMSIToNumpy(ABC):
         height = np.max(ys) + 1
         num_mzs = round(self.max_mz - self.min_mz + 1)
         if self.discrete_set_of_mzs:
-            img = np.zeros((height, width, len(set_of_mzs_quantized)), dtype=self.get_img_type())
+            img = allocate((height, width, len(set_of_mzs_quantized)), self.get_img_type())
         else:
-            img = np.zeros((height, width, self.bins_per_mz * num_mzs), dtype=self.get_img_type())
+            img = allocate((height, width, self.bins_per_mz * num_mzs), self.get_img_type())
         print("shape", img.shape)
         for x, y, mzs, intensities in tqdm.tqdm(zip(xs, ys, all_mzs, all_intensities)):
             intensities = np.array(intensities)
@@ -117,7 +118,15 @@ class BaseMSIToNumpy(ABC):
             mzs = np.arange(self.min_mz, self.max_mz + 1, 1.0/self.bins_per_mz)
             mzs = [float(f"{mzs[i]:.6f}") for i in range(img.shape[-1])]
 
-        return np.float32(img), mzs
+        if img.dtype != np.float32:
+            converted = allocate(img.shape, np.float32)
+            for rows in iter_chunks(img.shape[0], img[0].nbytes):
+                converted[rows] = img[rows]
+            # Free the intermediate cube (and its temporary file) before returning
+            del img
+            img = converted
+
+        return img, mzs
 
 
     @abstractmethod
@@ -1,6 +1,11 @@
 from msi_visual.base_dim_reduction import BaseDimReductionWithoutFit
+from msi_visual.neighbors import get_knn_graph
 from sklearn.manifold import Isomap
 
 class Isomap3D(BaseDimReductionWithoutFit):
-    def __init__(self):
-        super().__init__(model=Isomap(n_components=3), name="Isomap")
\ No newline at end of file
+    def __init__(self, landmarks=None):
+        super().__init__(model=Isomap(n_components=3, metric="precomputed"), name="Isomap", landmarks=landmarks)
+
+    def fit_transform(self, vector):
+        graph = get_knn_graph(vector, self.model.n_neighbors, 'euclidean')
+        return self.model.fit_transform(graph.to_sparse(self.model.n_neighbors))
\ No newline at end of file
@@ -0,0 +1,140 @@
+import os
+import time
+import joblib
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from msi_visual.kmeans_segmentation import KmeansSegmentation
+from msi_visual.nmf_segmentation import NMFSegmentation
+from msi_visual.memory import get_memory_budget
+from msi_visual.preprocessing import preprocess_pixels, sample_pixels
+from msi_visual.shared_memory import SharedArray, SharedPool
+from msi_visual.sparse import to_dense
+from msi_visual.tiling import load_cube
+
+FAMILIES = {"kmeans": KmeansSegmentation, "nmf": NMFSegmentation}
+
+
+def extend_centroids(vector, centroids, k, seed=0):
+    """Warm start centroids for a larger k: the given centroids, plus k-means++ style picks for the rest."""
+    rng = np.random.default_rng(seed)
+    centroids = np.float32(centroids)
+    norms = np.sum(vector ** 2, axis=-1)
+    distances = np.min(norms[:, None] - 2 * vector @ centroids.T + np.sum(centroids ** 2, axis=-1)[None, :], axis=1)
+    distances = np.maximum(distances, 0)
+    extra = []
+    for _ in range(k - len(centroids)):
+        if distances.sum() == 0:
+            index = rng.integers(len(vector))
+        else:
+            index = rng.choice(len(vector), p=distances / distances.sum())
+        extra.append(vector[index])
+        distances = np.minimum(distances, np.maximum(norms - 2 * vector @ vector[index] + norms[index], 0))
+    return np.concatenate([centroids, np.float32(extra).reshape(-1, vector.shape[-1])], axis=0)
+
+
+def extend_nmf(vector, W, H, k, seed=0):
+    """Warm start factors for a larger k: the given W and H, plus small random components like NMF's random init."""
+    rng = np.random.default_rng(seed)
+    scale = np.sqrt(vector.mean() / k)
+    extra = k - H.shape[0]
+    H = np.concatenate([H, scale * rng.random((extra, H.shape[1]))], axis=0)
+    W = np.concatenate([W, 0.01 * scale * rng.random((W.shape[0], extra))], axis=1)
+    return np.ascontiguousarray(W, dtype=vector.dtype), np.ascontiguousarray(H, dtype=vector.dtype)
+
+
+def fit_k(item, vector, warm_W=None):
+    """Fits one model of the sweep on the shared training matrix. Runs in the worker processes."""
+    family, k, params, warm = item
+    model = FAMILIES[family](k=k, **params)
+    t0 = time.time()
+    if family == "kmeans":
+        model.fit_vector(vector, None if warm is None else extend_centroids(vector, warm, k))
+        score = model.model.inertia_
+    else:
+        if warm is None:
+            model.fit_vector(vector)
+        else:
+            model.fit_vector(vector, *extend_nmf(vector, warm_W, warm, k))
+        score = model.model.reconstruction_err_
+    return model, time.time() - t0, score
+
+
+def k_sweep(family, images, ks, output_path, name_format="k{k}.joblib", start_bin=0, end_bin=None,
+            fit_pixels=None, warm_start=False, n_jobs=None, **params):
+    """Trains a segmentation model for every k on one shared preprocessed training matrix, k values in parallel.
+
+    Args:
+        family: 'kmeans' or 'nmf'.
+        images: list of cubes, memmaps or .npy paths.
+        name_format: model file name, formatted with k.
+        fit_pixels: train on a random subsample of this many tissue pixels instead of all the pixels.
+        warm_start: fit the smallest k first, and start all the larger k from its solution.
+        n_jobs: number of k values fitted in parallel. Every worker fits on its own copy of the matrix
+            (KMeans centers a copy of its input), so by default it is bounded by the memory budget.
+            The cores are split between the workers.
+        params: passed to the model constructor.
+    Returns:
+        A DataFrame with the fit time and the inertia / reconstruction error of every k,
+        also written to summary.csv in output_path.
+    """
+    images = [load_cube(img) if isinstance(img, str) else img for img in images]
+    start_bin, end_bin, _ = slice(start_bin, end_bin).indices(images[0].shape[-1])
+    if fit_pixels is not None:
+        shared = SharedArray(to_dense(sample_pixels(images, start_bin, end_bin, fit_pixels)))
+    else:
+        # The pixels are preprocessed straight into the shared buffer, the process holds a single copy.
+        shared = SharedArray.empty((sum(img.shape[0] * img.shape[1] for img in images), end_bin - start_bin))
+        start = 0
+        for img in images:
+            rows = img.shape[0] * img.shape[1]
+            preprocess_pixels(img, start_bin, end_bin, out=shared.array[start: start + rows])
+            start = start + rows
+        shared.array.flags.writeable = False
+    vector = shared.array
+    params = dict(params, start_bin=start_bin, end_bin=end_bin)
+    shapes = [img.shape[:2] for img in images]
+
+    ks = sorted(ks)
+    results = {}
+    arrays = {"vector": shared}
+    warm = None
+    try:
+        if warm_start and len(ks) > 1:
+            results[ks[0]] = fit_k((family, ks[0], params, None), vector)
+            model = results[ks[0]][0]
+            if family == "kmeans":
+                warm = model.model.cluster_centers_
+            else:
+                warm = model.H
+                arrays["warm_W"] = model.W
+
+        remaining = [k for k in ks if k not in results]
+        if remaining:
+            cpus = os.cpu_count() or 1
+            if n_jobs is None:
+                copies = (get_memory_budget() - vector.nbytes) // max(1, vector.nbytes)
+                n_jobs = int(max(1, min(len(remaining), cpus, copies)))
+            with SharedPool(n_jobs, threads_per_worker=max(1, cpus // n_jobs), **arrays) as pool:
+                for k, result in zip(remaining, pool.map(fit_k, [(family, k, params, warm) for k in remaining])):
+                    results[k] = result
+    finally:
+        del vector
+        shared.close()
+
+    os.makedirs(output_path, exist_ok=True)
+    rows = []
+    for k in ks:
+        model, fit_time, score = results[k]
+        model.train_image_shapes = shapes
+        if fit_pixels is not None and family == "nmf":
+            # W belongs to the subsample, visualize_training_components(images) projects the images instead.
+            model.W = None
+        path = str(Path(output_path) / name_format.format(k=k))
+        joblib.dump(model, path)
+        rows.append({"family": family, "k": k, "fit_time": fit_time,
+                     "inertia" if family == "kmeans" else "reconstruction_error": score,
+                     "path": path})
+    summary = pd.DataFrame(rows)
+    summary.to_csv(str(Path(output_path) / "summary.csv"), index=False)
+    return summary
@@ -1,30 +1,52 @@
 from PIL import Image
-from sklearn.cluster import KMeans
+from sklearn.cluster import KMeans, MiniBatchKMeans, kmeans_plusplus
 import cv2
 import numpy as np
 from matplotlib import pyplot as plt
-import torch
+from concurrent.futures import ThreadPoolExecutor
 from msi_visual.visualizations import visualizations_from_explanations
-from sklearn.metrics.pairwise import euclidean_distances, cosine_similarity
 import cmapy
 from msi_visual.utils import get_certainty
+from msi_visual.preprocessing import preprocess_pixels, iter_pixel_chunks, sample_pixels
+from msi_visual.tiling import load_cube
+from msi_visual.sparse import is_sparse, stack_rows, to_dense
+from sklearn.utils.extmath import row_norms
 
 
 class KmeansSegmentation:
+    # predict outputs k x H x W
+    tile_axis = 1
+    sparse_tiles = True
+
     def __init__(
             self,
             k,
             start_bin=0,
             end_bin=None,
             max_iter=200,
-            color_scheme='gist_rainbow', method='spatial_norm'):
-
+            color_scheme='gist_rainbow', method='spatial_norm',
+            fit_pixels=None,
+            mini_batch=False,
+            batch_size=1024,
+            max_passes=10,
+            tol=1e-3):
+        """
+        fit_pixels: cluster a random subsample of this many tissue pixels.
+        mini_batch: stream shuffled mini batches of the row chunks of the images through MiniBatchKMeans,
+                    starting from k-means++ centroids of a random subsample. At most max_passes passes
+                    over the images, stopping once a pass improves the inertia by less than tol (relative).
+        """
         self.k = k
         self.start_bin = start_bin
         self.end_bin = end_bin
         self.max_iter = max_iter
         self.color_scheme = color_scheme
         self.method = method
+        self.fit_pixels = fit_pixels
+        self.mini_batch = mini_batch
+        self.batch_size = batch_size
+        self.max_passes = max_passes
+        self.tol = tol
         self._trained = False
 
     def __repr__(self):
@@ -32,18 +54,62 @@ class KmeansSegmentation:
 
 
     def fit(self, images):
+        images = [load_cube(img) if isinstance(img, str) else img for img in images]
         if self.end_bin is None:
             self.end_bin = images[0].shape[-1]
-        vector = np.concatenate([img[:, :, self.start_bin:self.end_bin].reshape(
-            (img.shape[0] * img.shape[1]), -1) for img in images], axis=0)
-        vector = vector.reshape((-1, vector.shape[-1]))
-        self.model = KMeans(n_clusters=self.k, init='random', random_state=0)
-        self.model = self.model.fit(vector)
-        centroids = self.model.cluster_centers_
-        similarity = cosine_similarity(np.array(centroids), np.array(vector))
 
-        self.training_components = similarity
+        if self.mini_batch:
+            self.fit_mini_batch(images)
+        else:
+            if self.fit_pixels is not None:
+                vector = sample_pixels(images, self.start_bin, self.end_bin, self.fit_pixels)
+            else:
+                vector = stack_rows([preprocess_pixels(img, self.start_bin, self.end_bin)[0]
+                                     for img in images])
+            self.fit_vector(vector)
+
+        # The training components are computed on demand in visualize_training_components,
+        # so the model size does not grow with the training data.
         self.train_image_shapes = [img.shape[:2] for img in images]
+        self._trained = True
+
+    def fit_mini_batch(self, images):
+        # Initializing from the first mini batch would only see the top rows of the first image.
+        sample = sample_pixels(images, self.start_bin, self.end_bin, 3 * self.batch_size)
+        init, _ = kmeans_plusplus(to_dense(sample), self.k, random_state=0)
+        self.model = MiniBatchKMeans(n_clusters=self.k, init=init, n_init=1, random_state=0,
+                                     batch_size=self.batch_size)
+        rng = np.random.default_rng(0)
+        previous = None
+        for _ in range(self.max_passes):
+            inertia = 0.0
+            for img in images:
+                for chunk in iter_pixel_chunks(img, self.start_bin, self.end_bin, tissue_only=True):
+                    # Neighboring pixels are similar, mini batches of consecutive rows would be biased.
+                    chunk = chunk[rng.permutation(chunk.shape[0])]
+                    # Every mini batch needs at least k pixels.
+                    for start in range(0, chunk.shape[0] - self.k + 1, self.batch_size):
+                        self.model.partial_fit(chunk[start: start + self.batch_size])
+                        inertia += self.model.inertia_
+            if previous is not None and inertia > (1 - self.tol) * previous:
+                break
+            previous = inertia
+
+    def fit_vector(self, vector, init=None):
+        """KMeans on already preprocessed pixels.
+
+        Args:
+            vector: ndarray or CSR matrix of shape [N, D]
+            init: optional k x D initial centroids, to warm start from another solution.
+        """
+        if init is None:
+            self.model = KMeans(n_clusters=self.k, init='random', random_state=0)
+        else:
+            self.model = KMeans(n_clusters=self.k, init=init, n_init=1, random_state=0)
+        self.model = self.model.fit(vector)
+        # The per pixel training labels are not needed for prediction.
+        self.model.labels_ = None
+        self._trained = True
 
     def get_colors(self, color_scheme='gist_rainbow'):
         _cmap = plt.cm.get_cmap(color_scheme)
@@ -55,15 +121,52 @@ class KmeansSegmentation:
                 1.0 /
                 self.k)]
 
-    def visualize_training_components(self):
+    def get_similarity(self, img, softmax_scale=None):
+        """Cosine similarity of every pixel to every centroid, as float32 k x H x W.
+        Computed in row chunks with the centroids normalized once, so the temporaries are O(chunk x k).
+
+        Args:
+            softmax_scale: if set, a softmax over the centroids of the scaled similarities, applied in place.
+        """
+        centroids = np.float32(self.model.cluster_centers_)
+        centroids = centroids / np.maximum(np.linalg.norm(centroids, axis=-1, keepdims=True), 1e-12)
+        result = np.empty((img.shape[0] * img.shape[1], self.k), dtype=np.float32)
+        start = 0
+        for chunk in iter_pixel_chunks(img, self.start_bin, self.end_bin):
+            similarity = result[start: start + chunk.shape[0]]
+            if is_sparse(chunk):
+                similarity[...] = chunk @ centroids.T
+            else:
+                np.matmul(chunk, centroids.T, out=similarity)
+            # Pixels without intensity get a similarity of 0, like in cosine_similarity
+            similarity /= np.maximum(row_norms(chunk)[:, None], 1e-12)
+            if softmax_scale is not None:
+                similarity *= softmax_scale
+                similarity -= similarity.max(axis=-1, keepdims=True)
+                np.exp(similarity, out=similarity)
+                similarity /= similarity.sum(axis=-1, keepdims=True)
+            start = start + chunk.shape[0]
+        return result.T.reshape(self.k, img.shape[0], img.shape[1])
+
+    def visualize_training_components(self, images=None):
+        """
+        images: the training images. Only models saved by older versions still store the training components.
+        """
+        if images is None and not hasattr(self, 'training_components'):
+            raise ValueError("visualize_training_components needs the training images")
+
         result = []
         elements = 0
         for index, shape in enumerate(self.train_image_shapes):
-            img_elements = shape[0] * shape[1]
-            explanations = self.training_components[:,
-                                                    elements: elements + img_elements].copy()
-            explanations = explanations.reshape(self.k, shape[0], shape[1])
-            elements = elements + img_elements
+            if images is not None:
+                img = load_cube(images[index]) if isinstance(images[index], str) else images[index]
+                explanations = self.get_similarity(img)
+            else:
+                img_elements = shape[0] * shape[1]
+                explanations = self.training_components[:,
+                                                        elements: elements + img_elements].copy()
+                explanations = explanations.reshape(self.k, shape[0], shape[1])
+                elements = elements + img_elements
 
             spatial_sum_visualization, global_percentile_visualization, _, _ = visualizations_from_explanations(
                 shape, explanations, self.get_colors())
@@ -75,17 +178,13 @@ class KmeansSegmentation:
             self.fit([img])
             self._trained = True
 
-        img = img[:, :, self.start_bin:self.end_bin]
-        vector = img.reshape((-1, img.shape[-1]))
-        centroids = self.model.cluster_centers_
-        similarity = cosine_similarity(np.array(centroids), np.array(vector))
-        segmentation = similarity.reshape(self.k, img.shape[0], img.shape[1])
-        segmentation = torch.nn.Softmax(
-            dim=0)(
-            torch.from_numpy(
-                segmentation *
-                50)).numpy()
-        return segmentation
+        return self.get_similarity(img, softmax_scale=50)
+
+    def predict_images(self, images, n_jobs=None):
+        """predict for several slides in parallel threads. The matrix products release the GIL."""
+        images = [load_cube(img) if isinstance(img, str) else img for img in images]
+        with ThreadPoolExecutor(n_jobs) as pool:
+            return list(pool.map(self.predict, images))
 
     def __call__(self, img):
         return self.visualize(img, color_scheme=self.color_scheme, method=self.method)
@@ -0,0 +1,74 @@
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from sklearn.utils.extmath import row_norms
+from msi_visual.memory import iter_chunks
+from msi_visual.sparse import to_dense
+
+
+def sample_landmarks(vector, number_of_landmarks, mask=None):
+    """Coreset sampling of landmark pixels, without replacement.
+    Pixels far from the mean spectrum are favored, so that rare regions still get landmarks.
+
+    Args:
+        vector: ndarray or CSR matrix of shape [N, D]
+        number_of_landmarks: number of pixels to sample.
+        mask: optional bool [N] of the pixels that can be sampled, like the tissue.
+    Returns:
+        sorted int64 indices into vector.
+    """
+    candidates = np.arange(vector.shape[0]) if mask is None or not mask.any() else np.flatnonzero(mask)
+    # The candidates are read in row chunks, a copy of all the tissue pixels would double the memory.
+    chunks = list(iter_chunks(len(candidates), 4 * vector.shape[-1] * 4, fraction=0.1))
+    mean = np.zeros(vector.shape[-1], dtype=np.float64)
+    for rows in chunks:
+        mean += np.asarray(vector[candidates[rows]].sum(axis=0), dtype=np.float64).reshape(-1)
+    mean = mean / len(candidates)
+
+    # ||x - mean||^2 expanded, so that sparse pixels are not densified.
+    q = np.empty(len(candidates), dtype=np.float64)
+    for rows in chunks:
+        data = vector[candidates[rows]]
+        q[rows] = row_norms(data, squared=True) - 2 * (data @ mean) + mean @ mean
+    q = np.maximum(q, 0)
+    q = 0.5 * (q / (1e-12 + np.sum(q)) + 1.0 / len(candidates))
+    q = q / np.sum(q)
+    samples = np.random.choice(len(candidates), min(number_of_landmarks, len(candidates)),
+                               replace=False, p=q)
+    return np.sort(candidates[samples])
+
+
+def extend_embedding(vector, landmarks, embedding, k=10, landmark_indices=None, n_jobs=None):
+    """Out of sample extension: every pixel gets the inverse distance weighted average of the
+    embedding of its k nearest landmarks.
+
+    Args:
+        vector: ndarray or CSR matrix of shape [N, D]
+        landmarks: ndarray of shape [L, D]
+        embedding: ndarray of shape [L, K] - the embedding of the landmarks.
+        landmark_indices: optional rows of vector that are the landmarks, they keep their own embedding.
+    Returns:
+        float32 ndarray of shape [N, K]
+    """
+    landmarks = np.float32(landmarks)
+    embedding = np.float32(embedding)
+    landmark_norms = np.sum(landmarks ** 2, axis=-1)
+    k = min(k, len(landmarks))
+    result = np.empty((vector.shape[0], embedding.shape[-1]), dtype=np.float32)
+
+    def extend_chunk(rows):
+        chunk = np.float32(to_dense(vector[rows]))
+        # Squared euclidean distances with a matrix product, the BLAS call releases the GIL.
+        distances = np.sum(chunk ** 2, axis=-1)[:, None] - 2 * chunk @ landmarks.T + landmark_norms[None, :]
+        np.maximum(distances, 0, out=distances)
+        neighbors = np.argpartition(distances, k - 1, axis=-1)[:, :k]
+        distances = np.sqrt(np.take_along_axis(distances, neighbors, axis=-1))
+        weights = 1.0 / (1e-6 + distances)
+        weights = weights / np.sum(weights, axis=-1, keepdims=True)
+        result[rows] = np.sum(weights[:, :, None] * embedding[neighbors], axis=1)
+
+    chunks = list(iter_chunks(vector.shape[0], 4 * (len(landmarks) + 4 * k) * 4 + 4 * vector.shape[-1], fraction=0.1))
+    with ThreadPoolExecutor(n_jobs) as pool:
+        list(pool.map(extend_chunk, chunks))
+    if landmark_indices is not None:
+        result[landmark_indices] = embedding
+    return result
@@ -0,0 +1,108 @@
+import os
+import tempfile
+import weakref
+import contextlib
+import numpy as np
+
+_UNITS = {"b": 1, "kb": 1024, "mb": 1024 ** 2, "gb": 1024 ** 3, "tb": 1024 ** 4}
+_DEFAULT_BUDGET = 4 * 1024 ** 3
+_memory_budget = None
+
+
+def parse_size(size):
+    """Converts 16GB / "512 mb" / 1e9 to a number of bytes."""
+    if isinstance(size, str):
+        text = size.strip().lower().replace(" ", "")
+        for unit in sorted(_UNITS, key=len, reverse=True):
+            if text.endswith(unit):
+                return int(float(text[:-len(unit)]) * _UNITS[unit])
+        return int(float(text))
+    return int(size)
+
+
+def _available_memory():
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_AVPHYS_PAGES')
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def set_memory_budget(size):
+    """Sets the global memory budget (bytes, or a string like "16GB") that chunked kernels consult.
+    None goes back to the default: $MSI_VISUAL_MEMORY_BUDGET, or half of the available RAM."""
+    global _memory_budget
+    _memory_budget = None if size is None else parse_size(size)
+
+
+def get_memory_budget():
+    if _memory_budget is not None:
+        return _memory_budget
+    if "MSI_VISUAL_MEMORY_BUDGET" in os.environ:
+        return parse_size(os.environ["MSI_VISUAL_MEMORY_BUDGET"])
+    available = _available_memory()
+    if available is None:
+        return _DEFAULT_BUDGET
+    return available // 2
+
+
+@contextlib.contextmanager
+def memory_budget(size):
+    global _memory_budget
+    previous = _memory_budget
+    set_memory_budget(size)
+    try:
+        yield
+    finally:
+        _memory_budget = previous
+
+
+def chunk_size(bytes_per_row, n_rows=None, fraction=0.25, minimum=1):
+    """Number of rows whose temporaries (bytes_per_row each) fit in a fraction of the budget."""
+    rows = int(fraction * get_memory_budget() // max(1, int(bytes_per_row)))
+    rows = max(minimum, rows)
+    if n_rows is not None:
+        rows = min(rows, max(1, n_rows))
+    return rows
+
+
+def iter_chunks(n_rows, bytes_per_row, fraction=0.25):
+    step = chunk_size(bytes_per_row, n_rows, fraction)
+    for start in range(0, n_rows, step):
+        yield slice(start, min(n_rows, start + step))
+
+
+def fits_in_budget(nbytes, fraction=1.0):
+    return nbytes <= fraction * get_memory_budget()
+
+
+def allocate(shape, dtype, fraction=0.5):
+    """Zero initialized array. Arrays larger than the budget are backed by a temporary file,
+    so that huge cubes are streamed from disk instead of getting the process OOM-killed."""
+    nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+    if fits_in_budget(nbytes, fraction):
+        return np.zeros(shape, dtype=dtype)
+    handle, path = tempfile.mkstemp(suffix=".dat", prefix="msi_visual_")
+    os.close(handle)
+    array = np.memmap(path, dtype=dtype, mode='w+', shape=tuple(shape))
+    # The mapping stays valid after unlinking (POSIX), and the disk space is freed with the array.
+    # Where an open file can not be removed (Windows), it is removed once the array is collected.
+    try:
+        os.remove(path)
+    except OSError:
+        weakref.finalize(array, _remove_file, path)
+    return array
+
+
+def _remove_file(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def map_rows(func, vector, bytes_per_row=None, fraction=0.25):
+    """Applies a row-wise func (like model.transform) on chunks of rows and stacks the outputs."""
+    if bytes_per_row is None:
+        bytes_per_row = 4 * vector.shape[-1] * vector.dtype.itemsize
+    return np.concatenate([func(vector[rows])
+                           for rows in iter_chunks(vector.shape[0], bytes_per_row, fraction)], axis=0)
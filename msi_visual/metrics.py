@@ -3,7 +3,6 @@ from msi_visual.normalization import spatial_total_ion_count, total_ion_count, m
 from sklearn.metrics.pairwise import euclidean_distances, cosine_similarity
 from scipy.stats import entropy
 import random
-import time
 import sys
 import numpy as np
 import matplotlib
@@ -11,7 +10,11 @@ from PIL import Image
 import matplotlib.pyplot as plt
 import cv2
 from zadu import zadu
+from zadu.measures import local_continuity_meta_criteria
 from sklearn.manifold import trustworthiness
+from msi_visual.memory import get_memory_budget
+from msi_visual.shared_memory import SharedPool
+from msi_visual.neighbors import get_knn_graph
 
 def smoothness_saliency_metrics(cosine, maxabs, outputs):
     max_rank = np.maximum(
@@ -137,6 +140,11 @@ class MSIVisualizationMetrics:
         else:
             self.random_indices = random.sample(indices, num_samples // 5)
 
+        # The neighborhood metrics build dense subset x subset distance and rank matrices.
+        max_subset_size = int(np.sqrt(0.25 * get_memory_budget() / 24))
+        if len(self.random_indices) > max_subset_size:
+            self.random_indices = random.sample(self.random_indices, max_subset_size)
+
         self.data_subset = normalized.reshape(-1, normalized.shape[-1])
         self.visualization_subset = visualization.reshape((self.data_subset.shape[0], -1))
         self.data_subset = self.data_subset[self.random_indices]
@@ -162,21 +170,25 @@ class MSIVisualizationMetrics:
         metrics = smoothness_saliency_metrics(cosine, maxabs, outputs)
 
 
-        spec = [{"id": "mrre", "params": { "k": 100 },}, {"id": "lcmc", "params": { "k": 100 }}]
-        t0 = time.time()
+        spec = [{"id": "mrre", "params": { "k": 100 },}]
         scores = zadu.ZADU(spec, self.data_subset).measure(self.visualization_subset)
         for zadu_metric in scores:
             for m in zadu_metric:
                 metrics[m] = zadu_metric[m]
-        print("zadu took", time.time() - t0)
-        t0 = time.time()
+
+        # LCMC only needs the neighbor sets, the input graph is shared by all the visualizations of the subset.
+        # The graphs are exact, the metrics should not depend on the approximate search of large inputs.
+        # MRRE and trustworthiness use the rank of every point, not only of the k neighbors, so they keep their own.
+        k = min(100, len(self.data_subset) - 1)
+        data_knn, _ = get_knn_graph(self.data_subset, k, exact=True).neighbors(k, include_self=False)
+        visualization_knn, _ = get_knn_graph(np.float32(self.visualization_subset), k,
+                                             exact=True).neighbors(k, include_self=False)
+        metrics.update(local_continuity_meta_criteria.measure(self.data_subset, self.visualization_subset,
+                                                              k=k, knn_info=(data_knn, visualization_knn)))
         trustworthiness_score = trustworthiness(self.data_subset, self.visualization_subset, metric='euclidean', n_neighbors=100)
         trustworthiness_score_chevbyshev = trustworthiness(self.data_subset, self.visualization_subset, metric='chebyshev', n_neighbors=100)
         metrics["Trustworthiness"] = trustworthiness_score
         metrics["Trustworthiness L-∞"] = trustworthiness_score_chevbyshev
-
-        print(time.time() - t0, "trustwo")
-
         return metrics
 
     def get_correlation_scatter_plot(self, title=None):
@@ -257,6 +269,18 @@ class MSIVisualizationMetrics:
         return fig
 
 
+def _get_metrics(visualization, normalized, seed=0):
+    random.seed(seed)
+    return MSIVisualizationMetrics(normalized, visualization).get_metrics()
+
+
+def get_metrics_parallel(normalized, visualizations, n_jobs=None):
+    """Metrics for several visualizations of the same image, computed on a process pool.
+    The normalized cube is shared with the workers instead of being copied to each one."""
+    with SharedPool(n_jobs, normalized=normalized) as pool:
+        return pool.map(_get_metrics, visualizations)
+
+
 if __name__ == "__main__":
     img = np.load(sys.argv[1])
     visualization = np.array(Image.open(sys.argv[2]))
@@ -0,0 +1,154 @@
+import os
+import glob
+import hashlib
+from collections import OrderedDict
+from pathlib import Path
+import numpy as np
+import scipy.sparse
+from msi_visual.memory import iter_chunks
+
+_MAX_CACHED_GRAPHS = 4
+_graphs = OrderedDict()
+_cache_dir = None
+
+
+def set_knn_cache_dir(path):
+    """Directory where kNN graphs are persisted and looked up.
+    None goes back to the default: $MSI_VISUAL_KNN_CACHE, or only caching in memory."""
+    global _cache_dir
+    _cache_dir = None if path is None else str(path)
+
+
+def get_knn_cache_dir():
+    if _cache_dir is not None:
+        return _cache_dir
+    return os.environ.get("MSI_VISUAL_KNN_CACHE")
+
+
+def knn_cache_dir(cube_path):
+    """The directory next to an extracted cube where its kNN graphs are stored."""
+    cube_path = Path(cube_path)
+    return str(cube_path.parent / f"{cube_path.stem}_knn")
+
+
+def fingerprint(vector):
+    """A hash of the data, so that graphs are only reused for exactly the same pixels."""
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(str((vector.shape, vector.dtype.str)).encode())
+    for rows in iter_chunks(len(vector), vector[0].nbytes, fraction=0.05):
+        digest.update(np.ascontiguousarray(vector[rows]).data)
+    return digest.hexdigest()
+
+
+class KNNGraph:
+    """The k nearest neighbors of every row. Column 0 is the row itself, like in UMAP and TriMap.
+    exact is False for graphs from the approximate NN-descent search."""
+
+    def __init__(self, indices, distances, metric, exact=False):
+        self.indices = indices
+        self.distances = distances
+        self.metric = metric
+        self.exact = exact
+
+    @property
+    def k(self):
+        return self.indices.shape[1] - 1
+
+    def neighbors(self, k=None, include_self=True):
+        """
+        Returns:
+            indices: int64 ndarray of shape [N, k + 1] if include_self else [N, k].
+            distances: float32 ndarray of the same shape.
+        """
+        k = self.k if k is None else k
+        if include_self:
+            return self.indices[:, :k + 1], self.distances[:, :k + 1]
+
+        # With duplicate spectra the row itself is not necessarily in column 0.
+        indices, distances = self.indices[:, :k + 1], self.distances[:, :k + 1]
+        keep = indices != np.arange(len(indices))[:, None]
+        keep[keep.all(axis=1), -1] = False
+        return indices[keep].reshape(-1, k), distances[keep].reshape(-1, k)
+
+    def to_sparse(self, k=None):
+        """A [N, N] CSR distance matrix of the graph for metric='precomputed' consumers like Isomap.
+        Every row holds the row itself and its k neighbors, sorted by distance."""
+        indices, distances = self.neighbors(k, include_self=False)
+        n, k = indices.shape
+        indices = np.concatenate([np.arange(n)[:, None], indices], axis=1)
+        distances = np.concatenate([np.zeros((n, 1), dtype=distances.dtype), distances], axis=1)
+        return scipy.sparse.csr_matrix((distances.reshape(-1), indices.reshape(-1),
+                                        np.arange(0, n * (k + 1) + 1, k + 1)), shape=(n, n))
+
+    def save(self, path):
+        np.savez(path, indices=self.indices, distances=self.distances, metric=self.metric, exact=self.exact)
+
+    @staticmethod
+    def load(path):
+        with np.load(path) as data:
+            exact = bool(data["exact"]) if "exact" in data else False
+            return KNNGraph(data["indices"], data["distances"], str(data["metric"]), exact)
+
+
+def build_knn_graph(vector, k, metric='euclidean', n_jobs=-1, exact=False):
+    """Approximate kNN graph with NN-descent. Small inputs, or exact=True, get an exact brute force search."""
+    n_neighbors = min(k + 1, len(vector))
+    if exact or len(vector) < 4096:
+        from sklearn.neighbors import NearestNeighbors
+        distances, indices = NearestNeighbors(n_neighbors=n_neighbors, metric=metric,
+                                              n_jobs=n_jobs).fit(vector).kneighbors(vector)
+        return KNNGraph(np.int64(indices), np.float32(distances), metric, exact=True)
+    else:
+        from pynndescent import NNDescent
+        index = NNDescent(vector, metric=metric, n_neighbors=n_neighbors, n_jobs=n_jobs,
+                          low_memory=True, compressed=True)
+        indices, distances = index.neighbor_graph
+        return KNNGraph(np.int64(indices), np.float32(distances), metric)
+
+
+def _cache_path(cache_dir, key, metric, k, exact=False):
+    return os.path.join(cache_dir, f"{key}_{metric}{'_exact' if exact else ''}_k{k}.npz")
+
+
+def get_knn_graph(vector, k, metric='euclidean', cache_dir=None, exact=False):
+    """The kNN graph of vector, built once per data fingerprint, metric and k.
+    Graphs with a larger k are reused. If there is a cache directory, graphs are also persisted there,
+    so that other processes and later runs on the same cube skip building them.
+
+    Args:
+        vector: ndarray of shape [N, D]
+        k: number of neighbors, not counting the row itself.
+        cache_dir: defaults to get_knn_cache_dir().
+        exact: only use an exact graph, for evaluation metrics. Otherwise large inputs get an approximate graph.
+    """
+    # A row has at most N - 1 neighbors, the graphs of small inputs are stored with that k.
+    k = min(k, max(0, len(vector) - 1))
+    key = fingerprint(vector)
+    for (graph_key, graph_metric), graph in _graphs.items():
+        if graph_key == key and graph_metric == metric and graph.k >= k and (graph.exact or not exact):
+            _graphs.move_to_end((graph_key, graph_metric))
+            return graph
+
+    cache_dir = cache_dir or get_knn_cache_dir()
+    graph = None
+    if cache_dir is not None:
+        # Exact graphs can also serve the approximate requests
+        paths = glob.glob(_cache_path(cache_dir, key, metric, "*", exact=True))
+        if not exact:
+            paths += glob.glob(_cache_path(cache_dir, key, metric, "*"))
+        for path in paths:
+            cached_k = int(path[:-len(".npz")].rsplit("_k", 1)[-1])
+            if cached_k >= k:
+                graph = KNNGraph.load(path)
+                break
+
+    if graph is None:
+        graph = build_knn_graph(vector, k, metric, exact=exact)
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            graph.save(_cache_path(cache_dir, key, metric, k, graph.exact))
+
+    _graphs[(key, metric)] = graph
+    while len(_graphs) > _MAX_CACHED_GRAPHS:
+        _graphs.popitem(last=False)
+    return graph
@@ -1,5 +1,5 @@
 from PIL import Image
-from sklearn.decomposition import NMF, non_negative_factorization
+from sklearn.decomposition import NMF
 import cv2
 import numpy as np
 from matplotlib import pyplot as plt
@@ -7,29 +7,57 @@ import joblib
 from msi_visual.normalization import spatial_total_ion_count, total_ion_count, median_ion
 from msi_visual.visualizations import visualizations_from_explanations
 from msi_visual.utils import normalize, segment_visualization
+from msi_visual.preprocessing import preprocess_pixels
+from msi_visual.nnls import nnls_projection, fit_nmf_basis, project_images
+from msi_visual.tiling import load_cube
+from msi_visual.sparse import stack_rows
 
 
 class NMF3D:
-    def __init__(self, start_bin=0, end_bin=None, max_iter=2000):
+    # TileExecutor can hand it SparseCube tiles
+    sparse_tiles = True
+
+    def __init__(self, start_bin=0, end_bin=None, max_iter=2000, fit_pixels=None, mini_batch=False,
+                 batch_size=1024, max_passes=10):
+        """
+        fit_pixels: learn the components on a random subsample of this many tissue pixels.
+        mini_batch: learn the components with an online mini batch NMF over row chunks of the images,
+                    with mini batches of batch_size pixels and at most max_passes passes over the images.
+        """
         self.k = 3
         self.start_bin = start_bin
         self.end_bin = end_bin
         self.max_iter = max_iter
+        self.fit_pixels = fit_pixels
+        self.mini_batch = mini_batch
+        self.batch_size = batch_size
+        self.max_passes = max_passes
         self._trained = False
 
     def __repr__(self):
         return f"NMF-3D max_iter={self.max_iter}"
 
     def fit(self, images):
-        vector = np.concatenate([img.reshape(-1, images[0].shape[-1]) for img in images], axis=0)
-        vector = vector.reshape((-1, vector.shape[-1]))
-        self.model = NMF(
-            n_components=self.k,
-            init='random',
-            random_state=0,
-            max_iter=self.max_iter)
-        self.W = self.model.fit_transform(vector)
-        self.H = self.model.components_
+        images = [load_cube(img) if isinstance(img, str) else img for img in images]
+        if self.end_bin is None:
+            self.end_bin = images[0].shape[-1]
+
+        if self.fit_pixels is not None or self.mini_batch:
+            # Learn H on a subsample or online, then W of all the training pixels through the projection.
+            self.H = fit_nmf_basis(images, self.k, self.start_bin, self.end_bin, self.max_iter,
+                                   fit_pixels=self.fit_pixels, mini_batch=self.mini_batch,
+                                   batch_size=self.batch_size, max_passes=self.max_passes)
+            self.W = project_images(images, self.H, self.start_bin, self.end_bin)
+        else:
+            vector = stack_rows([preprocess_pixels(img, self.start_bin, self.end_bin)[0]
+                                 for img in images])
+            self.model = NMF(
+                n_components=self.k,
+                init='random',
+                random_state=0,
+                max_iter=self.max_iter)
+            self.W = self.model.fit_transform(vector)
+            self.H = self.model.components_
         self.train_image_shapes = [img.shape[:2] for img in images]
         self._trained = True
 
@@ -47,12 +75,15 @@ class NMF3D:
         return result
 
     def predict(self, img):
-        vector = img.reshape(
-            (-1, img.shape[-1]))
-        w_new, h_new, n_iter = non_negative_factorization(
-            vector, H=self.H, W=None, n_components=self.k, update_H=False, random_state=0)
-        result = w_new.transpose().reshape(self.k, img.shape[0], img.shape[1])
-        return np.uint8(255 * normalize(result.transpose((1, 2, 0))))
+        return self.finalize_tiles(self.predict_tile(img))
+
+    def predict_tile(self, img):
+        vector, _ = preprocess_pixels(img, self.start_bin, self.end_bin)
+        w_new = nnls_projection(vector, self.H)
+        return w_new.reshape(img.shape[0], img.shape[1], self.k)
+
+    def finalize_tiles(self, result):
+        return np.uint8(255 * normalize(result))
 
     def __call__(self, img):
         if not self._trained:
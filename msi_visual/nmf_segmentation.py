@@ -1,5 +1,5 @@
 from PIL import Image
-from sklearn.decomposition import NMF, non_negative_factorization
+from sklearn.decomposition import NMF
 import cv2
 import numpy as np
 from matplotlib import pyplot as plt
@@ -9,14 +9,31 @@ from msi_visual.visualizations import visualizations_from_explanations
 
 import cmapy
 from msi_visual.utils import get_certainty
+from msi_visual.preprocessing import preprocess_pixels
+from msi_visual.nnls import nnls_projection, fit_nmf_basis, project_images
+from msi_visual.tiling import load_cube
+from msi_visual.sparse import stack_rows
 
 
 class NMFSegmentation:
-    def __init__(self, k, start_bin=0, end_bin=None, max_iter=200, color_scheme='gist_rainbow', method='spatial_norm'):
+    # TileExecutor can hand it SparseCube tiles
+    sparse_tiles = True
+
+    def __init__(self, k, start_bin=0, end_bin=None, max_iter=200, color_scheme='gist_rainbow', method='spatial_norm',
+                 fit_pixels=None, mini_batch=False, batch_size=1024, max_passes=10):
+        """
+        fit_pixels: learn the components on a random subsample of this many tissue pixels.
+        mini_batch: learn the components with an online mini batch NMF over row chunks of the images,
+                    with mini batches of batch_size pixels and at most max_passes passes over the images.
+        """
         self.k = k
         self.start_bin = start_bin
         self.end_bin = end_bin
         self.max_iter = max_iter
+        self.fit_pixels = fit_pixels
+        self.mini_batch = mini_batch
+        self.batch_size = batch_size
+        self.max_passes = max_passes
         self.color_scheme = color_scheme
         self.method = method
         self._trained = False
@@ -25,20 +42,37 @@ class NMFSegmentation:
         return f"NMFSegmentation k={self.k} max_iter={self.max_iter} {self.method}"
 
     def fit(self, images):
+        images = [load_cube(img) if isinstance(img, str) else img for img in images]
         if self.end_bin is None:
             self.end_bin = images[0].shape[-1]
 
-        vector = np.concatenate([img[:, :, self.start_bin:self.end_bin].reshape(
-            -1, images[0][:, :, self.start_bin:self.end_bin].shape[-1]) for img in images], axis=0)
-        vector = vector.reshape((-1, vector.shape[-1]))
+        if self.fit_pixels is not None or self.mini_batch:
+            # Learn H on a subsample or online, then W of all the training pixels through the projection.
+            self.H = fit_nmf_basis(images, self.k, self.start_bin, self.end_bin, self.max_iter,
+                                   fit_pixels=self.fit_pixels, mini_batch=self.mini_batch,
+                                   batch_size=self.batch_size, max_passes=self.max_passes)
+            self.W = project_images(images, self.H, self.start_bin, self.end_bin)
+        else:
+            vector = stack_rows([preprocess_pixels(img, self.start_bin, self.end_bin)[0]
+                                 for img in images])
+            self.fit_vector(vector)
+        self.train_image_shapes = [img.shape[:2] for img in images]
+        self._trained = True
+
+    def fit_vector(self, vector, W=None, H=None):
+        """NMF on already preprocessed pixels.
+
+        Args:
+            vector: ndarray or CSR matrix of shape [N, D]
+            W, H: optional initial factors, to warm start from another solution.
+        """
         self.model = NMF(
             n_components=self.k,
-            init='random',
+            init='random' if W is None else 'custom',
             random_state=0,
             max_iter=self.max_iter)
-        self.W = self.model.fit_transform(vector)
+        self.W = self.model.fit_transform(vector, W=W, H=H)
         self.H = self.model.components_
-        self.train_image_shapes = [img.shape[:2] for img in images]
         self._trained = True
 
     def get_colors(self, color_scheme='gist_rainbow'):
@@ -51,13 +85,23 @@ class NMFSegmentation:
                 1.0 /
                 self.k)]
 
-    def visualize_training_components(self):
+    def visualize_training_components(self, images=None):
+        """
+        images: the training images. Needed if W of the training pixels was not kept, like after a k sweep on a subsample.
+        """
+        if images is None and self.W is None:
+            raise ValueError("visualize_training_components needs the training images")
+
         result = []
         elements = 0
         for index, shape in enumerate(self.train_image_shapes):
-            img_elements = shape[0] * shape[1]
-            w = self.W[elements: elements + img_elements, :].copy()
-            elements = elements + img_elements
+            if images is not None:
+                img = load_cube(images[index]) if isinstance(images[index], str) else images[index]
+                w = project_images([img], self.H, self.start_bin, self.end_bin)
+            else:
+                img_elements = shape[0] * shape[1]
+                w = self.W[elements: elements + img_elements, :].copy()
+                elements = elements + img_elements
             explanations = w.transpose().reshape(self.k, shape[0], shape[1])
             spatial_sum_visualization, global_percentile_visualization, _, _ = visualizations_from_explanations(
                 shape, explanations, self.get_colors())
@@ -68,10 +112,8 @@ class NMFSegmentation:
         if not self._trained:
             self.fit([img])
 
-        img = img[:, :, self.start_bin:self.end_bin]
-        vector = img.reshape((-1, img.shape[-1]))
-        w_new, h_new, n_iter = non_negative_factorization(
-            vector, H=self.H, W=None, n_components=self.k, update_H=False, random_state=0)
+        vector, _ = preprocess_pixels(img, self.start_bin, self.end_bin)
+        w_new = nnls_projection(vector, self.H)
         factorization = w_new.transpose().reshape(
             self.k, img.shape[0], img.shape[1])
         return factorization
@@ -0,0 +1,96 @@
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from sklearn.decomposition import NMF, MiniBatchNMF
+from msi_visual.memory import iter_chunks
+from msi_visual.preprocessing import preprocess_pixels, iter_pixel_chunks, sample_pixels
+from msi_visual.sparse import stack_rows
+
+
+def _project_chunk(vector, H, HHt, step, max_iter, tol):
+    XHt = vector @ H.T
+    # Start from the clipped unconstrained least squares solution.
+    W = np.maximum(XHt @ np.linalg.pinv(HHt), 0).astype(np.float32)
+    Y, t = W.copy(), 1.0
+    for _ in range(max_iter):
+        # Accelerated projected gradient step on 0.5 * ||X - W H||^2
+        W_new = np.maximum(Y - step * (Y @ HHt - XHt), 0)
+        t_new = (1 + np.sqrt(1 + 4 * t * t)) / 2
+        Y = W_new + ((t - 1) / t_new) * (W_new - W)
+        change = np.max(np.abs(W_new - W)) if len(W) else 0
+        W, t = W_new, t_new
+        if change <= tol * (1e-12 + np.max(W)):
+            break
+    return W
+
+
+def nnls_projection(vector, H, max_iter=500, tol=1e-5, n_jobs=None):
+    """Non negative W minimizing ||X - W H|| for a fixed H, like
+    non_negative_factorization(X, H=H, update_H=False), in float32 over pixel chunks on a thread pool.
+    H Hᵀ is computed once, so every iteration only costs O(N k²).
+
+    Args:
+        vector: ndarray or CSR matrix of shape [N, D]. Only X Hᵀ touches the pixels,
+                so a sparse vector costs O(nonzeros k).
+        H: ndarray of shape [k, D]
+    Returns:
+        float32 ndarray of shape [N, k]
+    """
+    H = np.float32(H)
+    HHt = H @ H.T
+    step = np.float32(1.0 / max(1e-12, np.linalg.eigvalsh(np.float64(HHt)).max()))
+    W = np.empty((vector.shape[0], len(H)), dtype=np.float32)
+
+    def project(rows):
+        W[rows] = _project_chunk(vector[rows].astype(np.float32), H, HHt, step, max_iter, tol)
+
+    chunks = list(iter_chunks(vector.shape[0], 2 * vector.shape[-1] * 4 + 8 * len(H) * 4, fraction=0.1))
+    with ThreadPoolExecutor(n_jobs) as pool:
+        list(pool.map(project, chunks))
+    return W
+
+
+def fit_nmf_basis(images, k, start_bin, end_bin, max_iter, fit_pixels=None, mini_batch=False,
+                  batch_size=1024, max_passes=10, tol=1e-4):
+    """Learns the NMF components H without concatenating all the pixels of all the images.
+
+    Args:
+        max_iter: the number of iterations of the full and subsampled fits.
+        fit_pixels: fit on a random subsample of this many tissue pixels.
+        mini_batch: fit an online MiniBatchNMF over shuffled mini batches of the row chunks of every image.
+            It makes at most max_passes passes over the images, and stops once a pass changes H by less than tol
+            (relative), so the training time grows with the slide area only through the number of mini batches.
+    Returns:
+        H: ndarray of shape [k, D]
+    """
+    if mini_batch:
+        # nndsvda starts the online fit much closer to the solution than a random H.
+        model = MiniBatchNMF(n_components=k, init='nndsvda', random_state=0, batch_size=batch_size)
+        rng = np.random.default_rng(0)
+        previous = None
+        for _ in range(max_passes):
+            for img in images:
+                for chunk in iter_pixel_chunks(img, start_bin, end_bin, tissue_only=True):
+                    # Neighboring pixels are similar, mini batches of consecutive rows would be biased.
+                    chunk = chunk[rng.permutation(chunk.shape[0])]
+                    for start in range(0, chunk.shape[0] - k + 1, batch_size):
+                        model.partial_fit(chunk[start: start + batch_size])
+            if previous is not None and \
+                    np.linalg.norm(model.components_ - previous) <= tol * np.linalg.norm(previous):
+                break
+            previous = model.components_.copy()
+        return model.components_
+
+    if fit_pixels is not None:
+        vector = sample_pixels(images, start_bin, end_bin, fit_pixels)
+    else:
+        vector = stack_rows([preprocess_pixels(img, start_bin, end_bin)[0] for img in images])
+    model = NMF(n_components=k, init='random', random_state=0, max_iter=max_iter)
+    model.fit(vector)
+    return model.components_
+
+
+def project_images(images, H, start_bin, end_bin):
+    """W of every pixel of every image for a fixed H, in row chunks, concatenated in the image order."""
+    return np.concatenate([nnls_projection(chunk, H)
+                           for img in images
+                           for chunk in iter_pixel_chunks(img, start_bin, end_bin)], axis=0)
@@ -1,4 +1,7 @@
-from umap import UMAP
+from collections import OrderedDict
+from umap.umap_ import fuzzy_simplicial_set, simplicial_set_embedding, find_ab_params
+from umap.distances import named_distances
+from sklearn.utils import check_random_state
 import tensorflow as tf
 import numpy as np
 import os
@@ -7,6 +10,11 @@ from pathlib import Path
 import joblib
 from msi_visual.normalization import spatial_total_ion_count, total_ion_count, median_ion
 from msi_visual.utils import normalize
+from msi_visual.preprocessing import preprocess_pixels
+from msi_visual.neighbors import get_knn_graph, fingerprint
+
+_MAX_CACHED_GRAPHS = 4
+_fuzzy_graphs = OrderedDict()
 
 def norm_umap_channel(channel, low=0.01, high=99.99):
     channel = channel - np.percentile(channel, low)
@@ -25,6 +33,24 @@ def embeddings_to_image(embeddings, rows, cols):
     return np.uint8(color_image * 255)
 
 
+def get_fuzzy_graph(vector, n_neighbors, metric):
+    """The UMAP fuzzy simplicial set of vector, cached by the data fingerprint, metric and n_neighbors.
+    Only the layout optimization depends on min_dist and n_components."""
+    key = (fingerprint(vector), metric, n_neighbors)
+    if key in _fuzzy_graphs:
+        _fuzzy_graphs.move_to_end(key)
+        return _fuzzy_graphs[key]
+
+    # The UMAP neighbors include the point itself.
+    indices, distances = get_knn_graph(vector, n_neighbors - 1, metric).neighbors(n_neighbors - 1)
+    graph, _, _ = fuzzy_simplicial_set(vector, n_neighbors, check_random_state(None), metric,
+                                       knn_indices=indices, knn_dists=distances)
+    _fuzzy_graphs[key] = graph
+    while len(_fuzzy_graphs) > _MAX_CACHED_GRAPHS:
+        _fuzzy_graphs.popitem(last=False)
+    return graph
+
+
 class MSINonParametricUMAP:
     def __init__(
             self,
@@ -45,15 +71,20 @@ class MSINonParametricUMAP:
         return f"MSINonParametricUMAP min_dist: {self.min_dist} n_neighbors: {self.n_neighbors} metric: {self.metric}"
 
     def predict(self, img):
-        vector = img.reshape(-1, img.shape[-1])[:, self.start_bin:self.end_bin]
-        output = UMAP(
-            n_components=self.n_components,
-            n_neighbors=self.n_neighbors,
-            metric=self.metric).fit_transform(vector)
+        vector, mask = preprocess_pixels(img, self.start_bin, self.end_bin)
+        graph = get_fuzzy_graph(vector, self.n_neighbors, self.metric)
+        # The defaults of UMAP(), except for the layout parameters.
+        a, b = find_ab_params(1.0, self.min_dist)
+        output, _ = simplicial_set_embedding(
+            vector, graph.copy(), self.n_components,
+            initial_alpha=1.0, a=a, b=b, gamma=1.0, negative_sample_rate=5, n_epochs=None,
+            init="spectral", random_state=check_random_state(None),
+            metric=named_distances[self.metric], metric_kwds={},
+            densmap=False, densmap_kwds={}, output_dens=False, parallel=True)
         output = output.reshape(img.shape[0], img.shape[1], output.shape[-1])
         visualization = embeddings_to_image(output, img.shape[0], img.shape[1])
         #visualization = cv2.cvtColor(visualization, cv2.COLOR_RGB2LAB)
-        visualization[img.max(axis=-1) == 0] = 0
+        visualization[mask == 0] = 0
 
         return visualization
 
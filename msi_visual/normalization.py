@@ -1,14 +1,28 @@
 
 import numpy as np
 import time
+from msi_visual.preprocessing import preprocess_pixels
+from msi_visual.memory import iter_chunks
 
 
-def total_ion_count(img):
-    return img / (1e-6 + np.sum(img, axis=-1)[:, :, None])
+def total_ion_count(img, return_mask=False):
+    """Every spectrum divided by its total ion count, as float32 whatever the input dtype.
+
+    Args:
+        return_mask: also return the [H, W] tissue mask, computed in the same pass.
+    """
+    vector, mask = preprocess_pixels(img, normalization='tic')
+    if return_mask:
+        return vector.reshape(img.shape), mask
+    return vector.reshape(img.shape)
 
 
 def median_ion(img):
-    return img / (1e-6 + np.median(img, axis=-1)[:, :, None])
+    result = np.empty(img.shape, dtype=np.result_type(img.dtype, np.float32))
+    for rows in iter_chunks(img.shape[0], 3 * img[0].nbytes):
+        chunk = img[rows]
+        result[rows] = chunk / (1e-6 + np.median(chunk, axis=-1)[:, :, None])
+    return result
 
 
 def spatial_total_ion_count(img):
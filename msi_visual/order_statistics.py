@@ -0,0 +1,84 @@
+import numpy as np
+import numba
+
+
+@numba.njit(cache=True)
+def _quickselect(a, lo, hi, k):
+    # Partially sorts a[lo:hi+1] in place so that a[k] is the k-th smallest value.
+    while hi > lo:
+        mid = (lo + hi) // 2
+        # Median of three pivot
+        if a[mid] < a[lo]:
+            a[mid], a[lo] = a[lo], a[mid]
+        if a[hi] < a[lo]:
+            a[hi], a[lo] = a[lo], a[hi]
+        if a[hi] < a[mid]:
+            a[hi], a[mid] = a[mid], a[hi]
+        pivot = a[mid]
+
+        i, j = lo, hi
+        while i <= j:
+            while a[i] < pivot:
+                i += 1
+            while a[j] > pivot:
+                j -= 1
+            if i <= j:
+                a[i], a[j] = a[j], a[i]
+                i += 1
+                j -= 1
+
+        if k <= j:
+            hi = j
+        elif k >= i:
+            lo = i
+        else:
+            return
+
+
+@numba.njit(parallel=True, cache=True)
+def _order_statistics_kernel(img, ranks, out, n_blocks):
+    H, W, C = img.shape
+    N = H * W
+    for block in numba.prange(n_blocks):
+        # One scratch spectrum per block instead of a sorted copy of the cube
+        buffer = np.empty(C, dtype=img.dtype)
+        for i in range(block * N // n_blocks, (block + 1) * N // n_blocks):
+            y, x = i // W, i % W
+            for c in range(C):
+                buffer[c] = img[y, x, c]
+            # Select the largest rank first, the smaller ones are then searched only below it.
+            hi = C - 1
+            for j in range(len(ranks) - 1, -1, -1):
+                _quickselect(buffer, 0, hi, ranks[j])
+                out[y, x, j] = buffer[ranks[j]]
+                hi = ranks[j]
+
+
+def order_statistics(img, ranks):
+    """The ranks[i]-th smallest intensity of every pixel, without sorting the spectra.
+
+    Args:
+        img: ndarray of shape [H, W, D].
+        ranks: list of integer ranks in [0, D).
+    Returns:
+        ndarray of shape [H, W, len(ranks)] with the dtype of img.
+    """
+    unique, inverse = np.unique(np.int64(ranks), return_inverse=True)
+    out = np.empty((img.shape[0], img.shape[1], len(unique)), dtype=img.dtype)
+    n_blocks = max(1, min(img.shape[0] * img.shape[1], 4 * numba.get_num_threads()))
+    _order_statistics_kernel(img, unique, out, n_blocks)
+    return out[:, :, inverse.reshape(-1)]
+
+
+def spectrum_percentiles(img, percentiles):
+    """Same as np.percentile(img, percentiles, axis=-1) (linear interpolation), with the percentiles in the last axis.
+
+    Returns:
+        float64 ndarray of shape [H, W, len(percentiles)]
+    """
+    positions = np.float64(percentiles) / 100 * (img.shape[-1] - 1)
+    low = np.int64(np.floor(positions))
+    high = np.int64(np.ceil(positions))
+    values = np.float64(order_statistics(img, np.concatenate([low, high])))
+    fraction = positions - low
+    return values[:, :, :len(low)] * (1 - fraction) + values[:, :, len(low):] * fraction
@@ -7,8 +7,11 @@ import time
 import cv2
 from PIL import Image
 from msi_visual.normalization import spatial_total_ion_count, total_ion_count, median_ion
-from sklearn.metrics.pairwise import pairwise_distances
 import numpy as np
+import numba
+from msi_visual.memory import iter_chunks
+from msi_visual.preprocessing import tissue_mask
+from msi_visual.neighbors import get_knn_graph
 
 
 def core_sets(data, Np):
@@ -40,24 +43,105 @@ def core_sets(data, Np):
     return coreset, weights, samples
 
 
-def get_outlier_image(img):
-    reshaped = img.reshape(img.shape[0] * img.shape[1], -1)
-    # nonzero = reshaped[reshaped.max(axis=-1) > 0]
+@numba.njit(parallel=True, cache=True)
+def _knn_chebyshev_kernel(img, offset, references, reference_pixels, distances, indices):
+    H, W, C = img.shape
+    k = distances.shape[-1]
+    for i in numba.prange(H * W):
+        y, x = i // W, i % W
+        pixel = offset + i
+        best = distances[pixel]
+        best_indices = indices[pixel]
+        best[:] = np.inf
+        best_indices[:] = -1
+        for j in range(len(references)):
+            # A reference is not its own neighbor
+            if reference_pixels[j] == pixel:
+                continue
+            d = 0.0
+            for c in range(C):
+                diff = abs(img[y, x, c] - references[j, c])
+                if diff > d:
+                    d = diff
+                    if d >= best[k - 1]:
+                        break
+            if d < best[k - 1]:
+                position = k - 1
+                while position > 0 and best[position - 1] > d:
+                    best[position] = best[position - 1]
+                    best_indices[position] = best_indices[position - 1]
+                    position -= 1
+                best[position] = d
+                best_indices[position] = j
+
+
+def knn_chebyshev(img, references, k=1, reference_pixels=None):
+    """L-inf distances from every pixel to its k nearest reference spectra, in float32, in row chunks.
 
-    coreset_indices = np.random.choice(
-        np.arange(len(reshaped)), size=100, replace=False)
-    coreset_indices = [
-        i for i in coreset_indices if reshaped[i, :].max(axis=-1) > 0]
-    coreset = reshaped[coreset_indices]
-
-    chebyshev = pairwise_distances(reshaped, coreset, metric='chebyshev')
-    for i, coreset_index in enumerate(coreset_indices):
-        chebyshev[coreset_index, i] = 10000
-
-    chebyshev = chebyshev.min(axis=-1)
+    Args:
+        img: ndarray of shape [H, W, D]
+        references: ndarray of shape [Np, D]
+        reference_pixels: optional flat pixel index of every reference, so that it is not matched with itself.
+    Returns:
+        distances: float32 ndarray [H * W, k], sorted ascending.
+        indices: int64 ndarray [H * W, k] of the matching references.
+    """
+    references = np.float32(references)
+    if reference_pixels is None:
+        reference_pixels = np.full(len(references), -1, dtype=np.int64)
+    H, W, C = img.shape
+    distances = np.empty((H * W, k), dtype=np.float32)
+    indices = np.empty((H * W, k), dtype=np.int64)
+    for rows in iter_chunks(H, 2 * img[0].nbytes):
+        _knn_chebyshev_kernel(np.asarray(img[rows]), rows.start * W, references,
+                              np.int64(reference_pixels), distances, indices)
+    return distances, indices
+
+
+def get_outlier_image(img, method='nearest', k=10, coreset_size=1000):
+    """
+    method: 'nearest' - the L-inf distance to the nearest of 100 random tissue pixels.
+            'knn' - a LOF-style score: the mean L-inf distance to the k nearest of coreset_size random tissue pixels,
+            relative to the same distance of those references.
+            'graph' - the same score, with the k nearest tissue pixels out of all of them,
+            from the shared L-inf kNN graph of the cube.
+    """
+    mask = tissue_mask(img).reshape(-1)
+    tissue = np.flatnonzero(mask)
+
+    if method not in ('nearest', 'knn', 'graph'):
+        raise Exception(f"{method} not supported as an outlier method")
+    elif len(tissue) < 2:
+        # No other tissue pixel to compare with
+        chebyshev = np.zeros(len(mask), dtype=np.float64)
+    elif method == 'nearest':
+        coreset_indices = np.random.choice(
+            np.arange(len(mask)), size=100, replace=False)
+        coreset_indices = coreset_indices[mask[coreset_indices]]
+        coreset = np.float32(img.reshape(-1, img.shape[-1])[coreset_indices])
+        distances, _ = knn_chebyshev(img, coreset, 1, coreset_indices)
+        chebyshev = np.float64(distances[:, 0])
+    elif method == 'knn':
+        coreset_indices = np.random.choice(
+            tissue, size=min(coreset_size, len(tissue)), replace=False)
+        coreset = np.float32(img.reshape(-1, img.shape[-1])[coreset_indices])
+        # A reference is compared with the len(coreset) - 1 others, more neighbors would stay unmatched
+        k = min(k, len(coreset) - 1)
+        distances, indices = knn_chebyshev(img, coreset, k, coreset_indices)
+        reference_distances, _ = knn_chebyshev(coreset[:, None, :], coreset, k, np.arange(len(coreset)))
+        reference_distances = reference_distances.mean(axis=-1)
+        chebyshev = np.float64(distances.mean(axis=-1) /
+                               (1e-6 + reference_distances[indices].mean(axis=-1)))
+    else:
+        k = min(k, len(tissue) - 1)
+        graph = get_knn_graph(np.float32(img.reshape(-1, img.shape[-1])[tissue]), k, 'chebyshev')
+        indices, distances = graph.neighbors(k, include_self=False)
+        mean_distances = distances.mean(axis=-1)
+        chebyshev = np.zeros(len(mask), dtype=np.float64)
+        chebyshev[tissue] = mean_distances / (1e-6 + mean_distances[indices].mean(axis=-1))
 
     chebyshev = chebyshev.reshape((img.shape[0], img.shape[1]))
-    chebyshev = chebyshev / np.percentile(chebyshev, 99.9)
+    chebyshev = chebyshev / max(np.percentile(chebyshev, 99.9), 1e-12)
     chebyshev[chebyshev > 1] = 1
 
     chebyshev = chebyshev - np.percentile(chebyshev, 0.01)
@@ -66,7 +150,7 @@ def get_outlier_image(img):
     visualization = cv2.merge([(np.uint8(255 * chebyshev)),
                                (np.uint8(255 * chebyshev)),
                                (np.uint8(255 * chebyshev))])
-    visualization[img.max(axis=-1) == 0] = 0
+    visualization[mask.reshape(img.shape[0], img.shape[1]) == 0] = 0
     visualization = cv2.applyColorMap(
         visualization, cmapy.cmap('viridis'))[:, :, ::-1]
 
@@ -1,24 +1,34 @@
-from msi_visual.base_dim_reduction import BaseDimReduction
-import pacmap
+from msi_visual.base_dim_reduction import BaseDimReductionWithoutFit
+from msi_visual.neighbors import get_knn_graph
 import numpy as np
-import joblib
-from msi_visual.utils import normalize
+import pacmap
+
+try:
+    # Private helpers of pacmap, used to sample the neighbor pairs from the shared graph.
+    from pacmap.pacmap import scale_dist, sample_neighbors_pair
+except ImportError:
+    scale_dist = sample_neighbors_pair = None
 
 
-class PACMAC3D():
-    def __init__(self):
-        self.model = pacmap.PaCMAP(n_components=3)
+class PACMAC3D(BaseDimReductionWithoutFit):
+    def __init__(self, landmarks=None):
+        super().__init__(model=pacmap.PaCMAP(n_components=3), name="PACMAC-3D", landmarks=landmarks)
 
-    def __repr__(self):
-        return f"PACMAC-3D"
-        
-    def __call__(self, img):
-        vector = img.reshape((-1, img.shape[-1]))
-        result = self.model.fit_transform(vector)
-        print(result.shape)
-        result = result.reshape(img.shape[0], img.shape[1], result.shape[-1])
-        return np.uint8(255 * normalize(result))
+    def fit_transform(self, vector):
+        if sample_neighbors_pair is None:
+            # Other pacmap versions, PaCMAP searches the neighbors itself.
+            return self.model.fit_transform(vector)
 
-    def save(self, path):
-        joblib.dump(self, path)
+        # Neighbor pairs sampled like PaCMAP does: the n_neighbors closest by scaled distance,
+        # out of the n_neighbors + 50 nearest. They come from the shared euclidean graph of the spectra,
+        # while PaCMAP itself searches the centered TruncatedSVD-100 projection of inputs with more than 100 bins,
+        # so the pairs are not exactly the ones PaCMAP would sample.
+        n_neighbors = self.model.n_neighbors
+        k = min(n_neighbors + 50, len(vector) - 1)
+        indices, distances = get_knn_graph(vector, k, 'euclidean').neighbors(k, include_self=False)
+        indices, distances = np.int32(indices), np.float32(distances)
+        sig = np.maximum(np.mean(distances[:, 3:6], axis=1), 1e-10)
+        pairs = sample_neighbors_pair(np.float32(vector), scale_dist(distances, sig, indices), indices, n_neighbors)
 
+        self.model.pair_neighbors, self.model.pair_MN, self.model.pair_FP = pairs, None, None
+        return self.model.fit_transform(vector, save_pairs=False)
@@ -1,5 +1,5 @@
 from PIL import Image
-from sklearn.decomposition import PCA
+from sklearn.decomposition import PCA, IncrementalPCA
 
 import cv2
 import numpy as np
@@ -8,26 +8,42 @@ import joblib
 from msi_visual.normalization import spatial_total_ion_count, total_ion_count, median_ion
 from msi_visual.visualizations import visualizations_from_explanations
 from msi_visual.utils import normalize, segment_visualization
+from msi_visual.preprocessing import preprocess_pixels
+from msi_visual.memory import map_rows, iter_chunks
+from msi_visual.tiling import TileExecutor, load_cube
+from msi_visual.sparse import is_sparse, read_rows, stack_rows, to_dense
 
 
 class PCA3D:
-    def __init__(self, start_bin=0, end_bin=None, max_iter=2000):
+    # TileExecutor can hand it SparseCube tiles
+    sparse_tiles = True
+
+    def __init__(self, start_bin=0, end_bin=None, max_iter=2000, streaming=False):
+        """
+        streaming: fit an IncrementalPCA on row chunks of every image, instead of concatenating all the images.
+                   The images can be memmaps or paths to .npy cubes, so dozens of slides can be used for training.
+        """
         self.k = 3
         self.start_bin = start_bin
         self.end_bin = end_bin
         self.max_iter = max_iter
+        self.streaming = streaming
         self._trained = False
 
     def __repr__(self):
         return f"PCA-3D max_iter={self.max_iter}"
 
     def fit(self, images):
+        images = [load_cube(img) if isinstance(img, str) else img for img in images]
         if self.end_bin is None:
             self.end_bin = images[0].shape[-1]
 
-        vector = np.concatenate([img[:, :, self.start_bin:self.end_bin].reshape(
-            -1, images[0][:, :, self.start_bin:self.end_bin].shape[-1]) for img in images], axis=0)
-        vector = vector.reshape((-1, vector.shape[-1]))
+        if self.streaming:
+            self.fit_streaming(images)
+            return
+
+        vector = stack_rows([preprocess_pixels(img, self.start_bin, self.end_bin)[0]
+                             for img in images])
 
         # # Normalize the data
         # vector_mean = np.mean(vector, axis=0)
@@ -36,22 +52,56 @@ class PCA3D:
         # vector_normalized = (vector - vector_mean) / (1e-6 + vector_std)
         # vector_normalized[:, vector_std == 0] = 0
 
-        # Transform the data using PCA
-        self.pca = PCA(n_components=self.k)
+        # Transform the data using PCA.
+        # For sparse pixels the arpack solver centers implicitly, so the CSR matrix is never densified.
+        self.pca = PCA(n_components=self.k, svd_solver='arpack' if is_sparse(vector) else 'auto')
         vector_transformed = self.pca.fit_transform(vector)
         # Save the PCA transform
         self.pca_transform = self.pca.transform
 
         self._trained = True
 
+    def fit_streaming(self, images):
+        self.pca = IncrementalPCA(n_components=self.k)
+        # Every partial fit needs at least n_components pixels. A chunk is fitted only once the next one
+        # is known to be large enough, smaller chunks are merged into the pending one.
+        pending = None
+        for img in images:
+            bytes_per_row = 4 * img.shape[1] * img.shape[2] * 4
+            for rows in iter_chunks(img.shape[0], bytes_per_row):
+                vector, _ = preprocess_pixels(read_rows(img, rows), self.start_bin, self.end_bin)
+                # partial_fit does not take sparse input, a chunk is small enough to densify.
+                vector = to_dense(vector)
+                if pending is None:
+                    pending = vector
+                elif len(pending) >= self.k and len(vector) >= self.k:
+                    self.pca.partial_fit(pending)
+                    pending = vector
+                else:
+                    pending = np.concatenate([pending, vector], axis=0)
+        if pending is None or len(pending) < self.k:
+            pixels = 0 if pending is None else len(pending)
+            raise ValueError(f"PCA3D needs at least {self.k} pixels to fit, the images have {pixels}")
+        self.pca.partial_fit(pending)
+
+        self.pca_transform = self.pca.transform
+        self._trained = True
 
     def predict(self, img):
-        vector = img[:, :, self.start_bin:self.end_bin].reshape(
-            (-1, img.shape[-1]))
+        # Streams the image in row tiles, so memmaps and paths are not read into RAM at once.
+        return TileExecutor(self)(img)
+
+    def predict_tile(self, img):
+        vector, _ = preprocess_pixels(img, self.start_bin, self.end_bin)
+        if isinstance(self.pca, IncrementalPCA):
+            # IncrementalPCA only transforms sparse input after a full fit, not after partial fits.
+            vector = to_dense(vector)
 
         #transformed_vector = (vector - self.mean) / (1e-6 + self.std)
-        result = self.pca_transform(vector)
-        result = result.reshape(img.shape[0], img.shape[1], result.shape[-1])
+        result = map_rows(self.pca_transform, vector)
+        return result.reshape(img.shape[0], img.shape[1], result.shape[-1])
+
+    def finalize_tiles(self, result):
         return np.uint8(255 * normalize(result))
 
     def __call__(self, img):
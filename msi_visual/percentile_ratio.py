@@ -3,6 +3,50 @@ import cv2
 import time
 import numba
 from msi_visual.normalization import spatial_total_ion_count, total_ion_count, median_ion
+from msi_visual.order_statistics import order_statistics
+
+
+@numba.njit(parallel=True, cache=True)
+def _top_k_kernel(img, mask, out):
+    H, W, C = img.shape
+    k = out.shape[-1]
+    # Loop through each tissue pixel and keep its top k values, sorted.
+    # Background pixels (no positive intensity, like in tissue_mask) are found in the same pass and get 0.
+    for i in numba.prange(H * W):
+        if not mask[i]:
+            continue
+        y, x = i // W, i % W
+        top = out[y, x]
+        top[:] = -np.inf
+        for c in range(C):
+            v = img[y, x, c]
+            if v > top[k - 1]:
+                # Shift down
+                position = k - 1
+                while position > 0 and top[position - 1] < v:
+                    top[position] = top[position - 1]
+                    position -= 1
+                top[position] = v
+        if top[0] <= 0:
+            top[:] = 0
+
+
+def top_k_intensities(img, k=3, mask=None):
+    """The k highest intensities of every pixel, in descending order.
+
+    Args:
+        img: ndarray of shape [H, W, D], float32 or uint32 are used directly.
+        mask: optional bool ndarray of shape [H, W]. Pixels outside it are skipped and get 0.
+            Without a mask, only the tissue pixels are kept, the background pixels get 0.
+    Returns:
+        float32 ndarray of shape [H, W, k]
+    """
+    H, W, _ = img.shape
+    if mask is None:
+        mask = np.ones(H * W, dtype=np.bool_)
+    out = np.zeros((H, W, k), dtype=np.float32)
+    _top_k_kernel(img, np.ascontiguousarray(mask).reshape(-1), out)
+    return out
 
 
 class TOP3:
@@ -15,35 +59,13 @@ class TOP3:
 
 
     def __call__(self, img: np.ndarray, power=1, to_lab=True):
-        @numba.njit(parallel=True, fastmath=True)
-        def get_p0p1p2(img):
-            H, W, C = img.shape
-            flat = img.reshape(-1, C)
-            N = flat.shape[0]
-
-            # Allocate output arrays
-            p0 = np.empty(N, dtype=np.float32)
-            p1 = np.empty(N, dtype=np.float32)
-            p2 = np.empty(N, dtype=np.float32)
-
-            # Loop through each pixel and find the top 3 values
-            for i in numba.prange(N):  # Parallelized loop
-                row = flat[i]
-                v0, v1, v2 = -np.inf, -np.inf, -np.inf
-
-                for v in row:
-                    if v > v0:
-                        v2, v1, v0 = v1, v0, v  # Shift down
-                    elif v > v1:
-                        v2, v1 = v1, v
-                    elif v > v2:
-                        v2 = v
-                
-                p0[i], p1[i], p2[i] = v0, v1, v2
-            p0, p1, p2 = p0.reshape(H, W), p1.reshape(H, W), p2.reshape(H, W)
-            return p0, p1, p2
-        
-        p0, p1, p2 = get_p0p1p2(img)
+        return self.finalize_tiles(self.predict_tile(img), power=power, to_lab=to_lab)
+
+    def predict_tile(self, img, mask=None):
+        return top_k_intensities(img, k=3, mask=mask)
+
+    def finalize_tiles(self, p, power=1, to_lab=True):
+        p0, p1, p2 = [np.float32(p[:, :, i]) for i in range(3)]
         if power != 1:
             p0 = np.power(p0, power)
             p1 = np.power(p1, power)
@@ -80,25 +102,29 @@ class PercentileRatio:
         return "Percentile Ratio"
 
     def __call__(self, img):
-        sorted_image = np.sort(img, axis=-1)
-        N = sorted_image.shape[-1]
+        return self.finalize_tiles(self.predict_tile(img))
 
-        p0 = sorted_image[:, :, int(N * self.percentiles[0] / 100)]
-        p1 = sorted_image[:, :, int(N * self.percentiles[1] / 100)]
-        p2 = sorted_image[:, :, int(N * self.percentiles[2] / 100)]
-        p3 = sorted_image[:, :, int(N * self.percentiles[3] / 100)]
-        p4 = sorted_image[:, :, int(N * self.percentiles[4] / 100)]
-        p5 = sorted_image[:, :, int(N * self.percentiles[5] / 100)]
+    def predict_tile(self, img):
+        N = img.shape[-1]
+        indices = [int(N * percentile / 100) for percentile in self.percentiles]
+        selected = order_statistics(img, indices)
+
+        p0, p1, p2, p3, p4, p5 = [selected[:, :, i] for i in range(len(indices))]
 
         a = p0 / (1e-5 + p1)
+        b = p2 / (1e-5 + p3)
+        c = p4 / (1e-5 + p5)
+        mask = img.max(axis=-1) > 0
+        return np.float32(np.dstack([a, b, c, mask]))
+
+    def finalize_tiles(self, ratios):
+        a, b, c, mask = [ratios[:, :, i].copy() for i in range(4)]
         a = a / np.percentile(a, 99.9)
         a[a > 1] = 1
 
-        b = p2 / (1e-5 + p3)
         b = b / np.percentile(b, 99.9)
         b[b > 1] = 1
 
-        c = p4 / (1e-5 + p5)
         c = c / np.percentile(c, 99.9)
         c[c > 1] = 1
 
@@ -107,5 +133,5 @@ class PercentileRatio:
                                     (np.uint8(255 * b)),
                                     (np.uint8(255 * c))])
         visualization = cv2.cvtColor(visualization, cv2.COLOR_LAB2LRGB)
-        visualization[img.max(axis=-1) == 0] = 0
+        visualization[mask == 0] = 0
         return visualization
@@ -0,0 +1,127 @@
+import numpy as np
+import numba
+import scipy.sparse as sp
+from msi_visual.memory import iter_chunks
+from msi_visual.sparse import SparseCube, read_rows, stack_rows
+
+
+@numba.njit(parallel=True, fastmath=True, cache=True)
+def _fused_preprocess(img, start_bin, end_bin, tic, rows, out, mask):
+    H, W, C = img.shape
+    for j in numba.prange(len(rows)):
+        i = rows[j]
+        y, x = i // W, i % W
+        total = 0.0
+        peak = 0.0
+        for c in range(C):
+            v = img[y, x, c]
+            total += v
+            if v > peak:
+                peak = v
+        mask[i] = peak > 0
+
+        scale = 1.0
+        if tic:
+            scale = 1.0 / (1e-6 + total)
+        for c in range(start_bin, end_bin):
+            out[j, c - start_bin] = img[y, x, c] * scale
+
+
+@numba.njit(parallel=True, cache=True)
+def _tissue_mask(img, mask):
+    H, W, C = img.shape
+    for i in numba.prange(H * W):
+        y, x = i // W, i % W
+        peak = 0.0
+        for c in range(C):
+            if img[y, x, c] > peak:
+                peak = img[y, x, c]
+        mask[i] = peak > 0
+
+
+def _sparse_tissue_mask(cube):
+    return (cube.matrix.max(axis=1).toarray().reshape(-1) > 0).reshape(cube.shape[0], cube.shape[1])
+
+
+def tissue_mask(img):
+    """Pixels with a non zero intensity, as a bool ndarray of shape [H, W]."""
+    if isinstance(img, SparseCube):
+        return _sparse_tissue_mask(img)
+    mask = np.empty(img.shape[0] * img.shape[1], dtype=np.bool_)
+    _tissue_mask(img, mask)
+    return mask.reshape(img.shape[0], img.shape[1])
+
+
+def preprocess_pixels(img, start_bin=0, end_bin=None, normalization=None, tissue_only=False, out=None):
+    """Slices, normalizes, masks and casts an MSI cube in a single parallel pass.
+
+    Args:
+        img: ndarray of shape [H, W, D]. Any numeric dtype, memmaps are read in place.
+            A SparseCube gives a CSR vector, computed in O(nonzeros).
+        start_bin, end_bin: m/z bin range to keep.
+        normalization: None, or 'tic' to divide every spectrum by its total ion count
+            (computed over the full spectrum, like total_ion_count).
+        tissue_only: keep only the rows of pixels that have a non zero intensity.
+        out: optional float32 ndarray of shape [H*W, end_bin - start_bin] to write the vector into,
+            like a shared memory buffer. Not with tissue_only.
+    Returns:
+        vector: float32 ndarray of shape [N, end_bin - start_bin], N=H*W unless tissue_only.
+        mask: bool ndarray of shape [H, W], True for tissue pixels.
+    """
+    if normalization not in (None, 'tic'):
+        raise Exception(f"{normalization} not supported as fused normalization")
+
+    H, W, C = img.shape
+    # Clamp the bin range like img[:, :, start_bin:end_bin], the kernel does not check bounds.
+    start_bin, end_bin, _ = slice(start_bin, end_bin).indices(C)
+    end_bin = max(start_bin, end_bin)
+
+    if isinstance(img, SparseCube):
+        vector, mask = _preprocess_sparse(img, start_bin, end_bin, normalization, tissue_only)
+        if out is None:
+            return vector, mask
+        # toarray adds to the buffer
+        out[...] = 0
+        vector.toarray(out=out)
+        return out, mask
+
+    mask = np.empty(H * W, dtype=np.bool_)
+    if tissue_only:
+        _tissue_mask(img, mask)
+        rows = np.flatnonzero(mask)
+    else:
+        rows = np.arange(H * W)
+
+    if out is None:
+        vector = np.empty((len(rows), end_bin - start_bin), dtype=np.float32)
+    else:
+        vector = out
+    _fused_preprocess(img, start_bin, end_bin, normalization == 'tic', rows, vector, mask)
+    return vector, mask.reshape(H, W)
+
+
+def _preprocess_sparse(cube, start_bin, end_bin, normalization, tissue_only):
+    mask = _sparse_tissue_mask(cube)
+    vector = cube.matrix[:, start_bin:end_bin].astype(np.float32)
+    if normalization == 'tic':
+        total = np.asarray(cube.matrix.sum(axis=1), dtype=np.float64).reshape(-1)
+        vector = sp.diags(np.float32(1.0 / (1e-6 + total))) @ vector
+    if tissue_only:
+        vector = vector[np.flatnonzero(mask.reshape(-1))]
+    return sp.csr_matrix(vector), mask
+
+
+def iter_pixel_chunks(img, start_bin=0, end_bin=None, tissue_only=False):
+    """preprocess_pixels over memory budgeted row chunks, for cubes that do not fit in RAM."""
+    for rows in iter_chunks(img.shape[0], 4 * img.shape[1] * img.shape[2] * 4):
+        yield preprocess_pixels(read_rows(img, rows), start_bin, end_bin, tissue_only=tissue_only)[0]
+
+
+def sample_pixels(images, start_bin, end_bin, number_of_pixels, seed=0):
+    """About number_of_pixels random tissue pixels out of all the images, read in row chunks."""
+    rng = np.random.default_rng(seed)
+    total = sum(int(tissue_mask(img).sum()) for img in images)
+    probability = min(1.0, number_of_pixels / max(1, total))
+    return stack_rows([chunk[rng.random(chunk.shape[0]) < probability]
+                       for img in images
+                       for chunk in iter_pixel_chunks(img, start_bin, end_bin, tissue_only=True)])
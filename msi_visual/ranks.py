@@ -0,0 +1,83 @@
+import numpy as np
+import numba
+
+
+@numba.njit(cache=True)
+def _rank_row(distances, out):
+    # out[j] = position of distances[j] in the sorted row, like distances.argsort().argsort()
+    order = np.argsort(distances, kind='mergesort')
+    for rank in range(len(order)):
+        out[order[rank]] = rank
+
+
+@numba.njit(parallel=True, fastmath=True, cache=True)
+def _distance_ranks_kernel(pixels, references_t, max_ranks, cosine_ranks, with_cosine, n_blocks):
+    N, D = pixels.shape
+    Np = references_t.shape[1]
+    reference_norms = np.zeros(Np, dtype=np.float32)
+    for c in range(D):
+        for j in range(Np):
+            reference_norms[j] += references_t[c, j] * references_t[c, j]
+    reference_norms = np.sqrt(reference_norms)
+
+    for block in numba.prange(n_blocks):
+        # Scratch rows per block, the N x Np distance matrices are never materialized.
+        dot = np.empty(Np, dtype=np.float32)
+        chebyshev = np.empty(Np, dtype=np.float32)
+        cosine = np.empty(Np, dtype=np.float32)
+        cosine_rank = np.empty(Np, dtype=np.int64)
+        chebyshev_rank = np.empty(Np, dtype=np.int64)
+        for i in range(block * N // n_blocks, (block + 1) * N // n_blocks):
+            dot[:] = 0
+            chebyshev[:] = 0
+            norm = np.float32(0)
+            # The references are transposed, so that the inner loop over them vectorizes.
+            for c in range(D):
+                value = np.float32(pixels[i, c])
+                norm += value * value
+                for j in range(Np):
+                    dot[j] += value * references_t[c, j]
+                    chebyshev[j] = max(chebyshev[j], abs(value - references_t[c, j]))
+            norm = np.sqrt(norm)
+
+            for j in range(Np):
+                # Zero vectors have a cosine similarity of 0, like in sklearn's cosine_distances
+                if norm > 0 and reference_norms[j] > 0:
+                    cosine[j] = 1 - dot[j] / (norm * reference_norms[j])
+                else:
+                    cosine[j] = 1
+
+            _rank_row(cosine, cosine_rank)
+            _rank_row(chebyshev, chebyshev_rank)
+            for j in range(Np):
+                max_ranks[i, j] = max(cosine_rank[j], chebyshev_rank[j])
+                if with_cosine:
+                    cosine_ranks[i, j] = cosine_rank[j]
+
+
+def rank_dtype(number_of_references):
+    """The smallest integer type that holds ranks among number_of_references points."""
+    return np.int16 if number_of_references <= np.iinfo(np.int16).max + 1 else np.int32
+
+
+def distance_ranks(pixels, references, return_cosine=False):
+    """Rank of every reference point by its distance from every pixel, computed in float32 in one parallel pass.
+
+    Args:
+        pixels: ndarray of shape [N, D]. Memmaps are read in place.
+        references: ndarray of shape [Np, D]
+        return_cosine: also return the cosine distance ranks.
+    Returns:
+        max_ranks: the maximum of the cosine and chebyshev distance ranks, int16 (int32 above 32768 references)
+            ndarray of shape [N, Np].
+        cosine_ranks: only with return_cosine, the cosine distance ranks in the same dtype.
+    """
+    dtype = rank_dtype(len(references))
+    max_ranks = np.empty((len(pixels), len(references)), dtype=dtype)
+    cosine_ranks = np.empty((len(pixels) if return_cosine else 0, len(references)), dtype=dtype)
+    n_blocks = max(1, min(len(pixels), 4 * numba.get_num_threads()))
+    references_t = np.ascontiguousarray(np.float32(references).T)
+    _distance_ranks_kernel(pixels, references_t, max_ranks, cosine_ranks, return_cosine, n_blocks)
+    if return_cosine:
+        return max_ranks, cosine_ranks
+    return max_ranks
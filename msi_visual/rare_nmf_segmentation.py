@@ -4,11 +4,13 @@ from PIL import Image
 import numpy as np
 from msi_visual.utils import normalize_image_grayscale, image_histogram_equalization
 from msi_visual.normalization import spatial_total_ion_count
+from msi_visual.order_statistics import spectrum_percentiles
 
 
 def get_pr(normalized, high=99.9, low=99):
-    novel = np.percentile(normalized, high, axis=-1) / \
-        (1e-5 + np.percentile(normalized, low, axis=-1))
+    percentiles = spectrum_percentiles(normalized, [high, low])
+    novel = percentiles[:, :, 0] / \
+        (1e-5 + percentiles[:, :, 1])
     novel = novel / np.percentile(novel, 99)
     novel[novel > 1] = 1
     return np.uint8(255 * novel)
@@ -21,7 +21,15 @@ class SaliencyClusteringOptimization(SaliencyOptimization):
             init="random",
             similarity_reg=0,
             number_of_components=3,
-            lab_to_rgb=True):
+            lab_to_rgb=True,
+            batch_size=None,
+            device=None,
+            num_threads=None,
+            compile=False,
+            dtype="float32",
+            pyramid=None,
+            pyramid_epochs=50,
+            convergence=None):
         super().__init__(
             number_of_points=number_of_points,
             regularization_strength=regularization_strength,
@@ -30,7 +38,15 @@ class SaliencyClusteringOptimization(SaliencyOptimization):
             init=init,
             similarity_reg=similarity_reg,
             number_of_components=number_of_components,
-            lab_to_rgb=lab_to_rgb
+            lab_to_rgb=lab_to_rgb,
+            batch_size=batch_size,
+            device=device,
+            num_threads=num_threads,
+            compile=compile,
+            dtype=dtype,
+            pyramid=pyramid,
+            pyramid_epochs=pyramid_epochs,
+            convergence=convergence
         )
         self.clusters = clusters
         self.cluster_fraction = cluster_fraction
@@ -38,13 +54,12 @@ class SaliencyClusteringOptimization(SaliencyOptimization):
         
         for k in self.clusters:
             l = torch.nn.Sequential(torch.nn.Linear(self.number_of_components, k))
-            if torch.cuda.is_available():
-                l = l.cuda()
             self.visualiation_to_cluster.append(l)
 
 
-    def set_image(self, img):
-        super().set_image(img)
+    def set_image(self, img, embedding=None):
+        super().set_image(img, embedding)
+        self.visualiation_to_cluster = [layer.to(self.torch_device) for layer in self.visualiation_to_cluster]
         self.cluster_labels = []
         t0 = time.time()
         for k in self.clusters:
@@ -54,21 +69,22 @@ class SaliencyClusteringOptimization(SaliencyOptimization):
             random_indices = np.random.choice(self.reshaped.shape[0], num_samples, replace=False)
             sampled_data = self.reshaped[random_indices]
             kmeans.fit(sampled_data)
-            labels = torch.from_numpy(kmeans.predict(self.reshaped)).long()
-            if torch.cuda.is_available():
-                labels = labels.cuda()
+            labels = torch.from_numpy(kmeans.predict(self.reshaped)).long().to(self.torch_device)
             self.cluster_labels.append(labels)
         
         print("Done with clustering", time.time() - t0)
 
 
 
-    def get_loss(self):
-        saliency_loss = super().get_loss()
+    def get_loss(self, rows=None):
+        saliency_loss = super().get_loss(rows)
+        visualization = self.embed(rows)
         loss = None
         for layer, clusters in zip(self.visualiation_to_cluster, self.cluster_labels):
             cluster_loss = None
-            cluster_loss = torch.nn.CrossEntropyLoss()(layer(self.visualization), clusters)
+            if rows is not None:
+                clusters = clusters[rows]
+            cluster_loss = torch.nn.CrossEntropyLoss()(layer(visualization), clusters)
             if loss is None:
                 loss = cluster_loss
             else:
@@ -5,12 +5,38 @@ from PIL import Image
 import tqdm
 import torchsort
 import cv2
+from msi_visual.memory import fits_in_budget
+from msi_visual.ranks import distance_ranks, rank_dtype
+from msi_visual.devices import get_device, get_compute_dtype, set_num_threads
+from msi_visual.convergence import sample_validation_pairs, hard_ranks
 
 from msi_visual.percentile_ratio import TOP3
 from sklearn.cluster import KMeans, kmeans_plusplus
 from msi_visual.utils import normalize
 
 
+def downsample_cube(img, factor):
+    """Sums the spectra of factor x factor pixel blocks: [H, W, D] -> float32 [ceil(H / factor), ceil(W / factor), D].
+    Read one row of blocks at a time, so memmapped cubes are not loaded at once."""
+    H, W, D = img.shape
+    h, w = -(-H // factor), -(-W // factor)
+    result = np.empty((h, w, D), dtype=np.float32)
+    block = np.zeros((factor, w * factor, D), dtype=np.float32)
+    for i in range(h):
+        rows = img[i * factor: (i + 1) * factor]
+        block[...] = 0
+        block[:len(rows), :W] = rows
+        result[i] = block.reshape(factor, w, factor, D).sum(axis=(0, 2))
+    return result
+
+
+def upsample_embedding(embedding, factor, shape):
+    """Bilinear upsampling of an [h, w, C] embedding by factor, cropped to shape (the [H, W] of the finer level)."""
+    h, w = embedding.shape[:2]
+    upsampled = cv2.resize(np.float32(embedding), (w * factor, h * factor), interpolation=cv2.INTER_LINEAR)
+    return upsampled.reshape(h * factor, w * factor, -1)[:shape[0], :shape[1]]
+
+
 class SaliencyOptimization:
     def __init__(
             self,
@@ -21,7 +47,34 @@ class SaliencyOptimization:
             init="random",
             similarity_reg=0,
             number_of_components=3,
-            lab_to_rgb=True):
+            lab_to_rgb=True,
+            batch_size=None,
+            device=None,
+            num_threads=None,
+            compile=False,
+            dtype="float32",
+            pyramid=None,
+            pyramid_epochs=50,
+            convergence=None):
+        """
+        batch_size: if set, every epoch is a pass over the tissue pixels in random mini batches of this many pixels.
+                    Only the embeddings of the batch and of the reference points are updated in a step (SparseAdam),
+                    and the input ranks of the batch are computed on the fly when they do not fit in the memory budget,
+                    so memory is O(batch_size x number_of_points) instead of O(pixels x number_of_points).
+        device: torch device name, like 'cpu' or 'cuda'. By default cuda when it is available.
+        num_threads: number of torch CPU threads.
+        compile: torch.compile the loss.
+        dtype: 'float32', or 'bfloat16' to store the cached pixels x references rank weights (the squared input ranks)
+               in half the memory. Their relative error is below 0.4%, bfloat16 holds integers exactly only up to 256.
+               The ranks, the loss terms and the reductions are always float32.
+        pyramid: optional decreasing downsampling factors, like (4, 2), each a multiple of the next.
+                 The visualization is first optimized for pyramid_epochs on the cube with its spectra summed over
+                 4x4 blocks, then upsampled as the initialization of the 2x2 level, and so on.
+                 num_epochs are then run at full resolution, and can be much fewer than without the pyramid.
+        convergence: optional ConvergenceMonitor. Every level stops early once the loss plateaus,
+                     num_epochs and pyramid_epochs become upper bounds. The epochs that were run are in
+                     epochs_used (full resolution) and pyramid_epochs_used.
+        """
         self.num_epochs = num_epochs
         self.regularization_strength = regularization_strength
         self.sampling = sampling
@@ -30,6 +83,14 @@ class SaliencyOptimization:
         self.similarity_reg = similarity_reg
         self.number_of_components = number_of_components
         self.lab_to_rgb = lab_to_rgb
+        self.batch_size = batch_size
+        self.device = device
+        self.num_threads = num_threads
+        self.compile = compile
+        self.dtype = dtype
+        self.pyramid = pyramid
+        self.pyramid_epochs = pyramid_epochs
+        self.convergence = convergence
 
     def __repr__(self):
         return f"Saliency Optimization: num_epochs: {self.num_epochs} regularization_strength: {self.regularization_strength} \
@@ -71,14 +132,24 @@ class SaliencyOptimization:
             # get sample and fill coreset
             return np.random.choice(N, Np, p=q)
 
-    def set_image(self, img):
+    def set_image(self, img, embedding=None):
+        """
+        embedding: optional [H, W, number_of_components] initial embedding, like an upsampled coarser solution.
+                   Used instead of init.
+        """
+        self.torch_device = get_device(self.device)
+        self.compute_dtype = get_compute_dtype(self.dtype)
+        set_num_threads(self.num_threads)
         self.img = img
         self.reshaped = self.img.reshape(
             self.img.shape[0] * self.img.shape[1], -1)
         self.img_mask = self.img.max(axis=-1) > 0
         self.resample(number_of_points=self.number_of_points)
 
-        if isinstance(self.init, np.ndarray):
+        if embedding is not None:
+            self.visualization = torch.from_numpy(np.float32(embedding)).reshape(-1, self.number_of_components)
+
+        elif isinstance(self.init, np.ndarray):
             self.visualization = torch.from_numpy(
                 np.float32(self.init) / 255) * 10 - 5
             self.visualization = self.visualization.reshape(-1, self.number_of_components)
@@ -93,20 +164,57 @@ class SaliencyOptimization:
         else:
             raise Exception(f"{self.init} not supported as initialization")
 
-        if torch.cuda.is_available():
-            self.visualization = self.visualization.cuda()
+        self.visualization = self.visualization.to(self.torch_device)
 
         if self.similarity_reg > 0:
             self.orig = self.visualization.clone()
 
         self.visualization.requires_grad = True
-        self.optim = torch.optim.Adam([self.visualization], lr=1.0)
+        if self.batch_size is None:
+            self.optim = torch.optim.Adam([self.visualization], lr=1.0)
+        else:
+            self.optim = torch.optim.SparseAdam([self.visualization], lr=1.0)
         delta = 0.0
 
         self.loss_saliency = torch.nn.MarginRankingLoss(
             margin=-delta, reduction='none')
         self.mask_np = self.reshaped.max(axis=-1) > 0
-        self.mask = torch.from_numpy(self.mask_np).float().cuda()
+        self.mask = torch.from_numpy(self.mask_np).to(self.torch_device, torch.float32)
+        self.loss_step = torch.compile(self.get_loss) if self.compile else self.get_loss
+        self.tissue_rows = torch.from_numpy(np.flatnonzero(self.mask_np)).to(self.visualization.device)
+
+        if self.convergence is not None:
+            self.convergence.reset()
+            if self.convergence.validation_pixels:
+                self.set_validation_pairs()
+
+    def set_validation_pairs(self):
+        """Held out pixels and reference points for the convergence metric, with their input ranks."""
+        pixel_rows, reference_rows = sample_validation_pairs(self.mask_np, self.indices,
+                                                             self.convergence.validation_pixels,
+                                                             self.convergence.validation_points)
+        input_ranks = distance_ranks(self.reshaped[pixel_rows], self.reshaped[reference_rows])
+        self.validation_rows = torch.from_numpy(pixel_rows).to(self.torch_device)
+        self.validation_references = torch.from_numpy(reference_rows).to(self.torch_device)
+        self.validation_input_ranks = torch.from_numpy(input_ranks).to(self.torch_device).float()
+
+    def validation_loss(self):
+        """The rank loss on the held out pairs, with hard output ranks."""
+        with torch.no_grad():
+            output_distances = torch.cdist(self.visualization[self.validation_rows],
+                                           self.visualization[self.validation_references])
+            output_ranks = hard_ranks(output_distances).float()
+            weights = self.validation_input_ranks ** 2
+            loss = torch.relu(self.validation_input_ranks - output_ranks) * weights
+            return float(loss.sum() / weights.sum())
+
+    def converged(self, loss):
+        """Feeds the epoch to the convergence monitor. Returns True when the optimization should stop."""
+        if self.convergence is None:
+            return False
+        if self.convergence.validation_pixels:
+            return self.convergence.update(self.validation_loss())
+        return self.convergence.update(loss)
 
     def resample(self, number_of_points):
         sampled_indices = self.get_reference_points(
@@ -114,62 +222,151 @@ class SaliencyOptimization:
         self.indices = [
             i for i in sampled_indices if self.reshaped[i, :].max(axis=-1) > 0]
 
-        reference_points = self.reshaped[self.indices, :]
-
-        cosine = pairwise_distances(
-            self.reshaped,
-            reference_points,
-            metric='cosine')
-        chebyshev = pairwise_distances(
-            self.reshaped, reference_points, metric='chebyshev')
-
-        cosine = cosine.argsort().argsort()
-        chebyshev = chebyshev.argsort().argsort()
-        self.input_max_rank = torch.from_numpy(np.maximum(chebyshev, cosine))
-        if torch.cuda.is_available():
-            self.input_max_rank = self.input_max_rank.cuda()
-        self.rank_squares = self.input_max_rank ** 2
-
-    def predict(self, img):
-        self.set_image(img)
-        for _ in range(self.num_epochs):
-            output = self.compute_epoch()
+        self.reference_points = self.reshaped[self.indices, :]
+        self.reference_rows = torch.tensor(self.indices, dtype=torch.int64, device=self.torch_device)
+
+        bytes_per_pair = np.dtype(rank_dtype(len(self.indices))).itemsize + self.compute_dtype.itemsize
+        if self.batch_size is not None and \
+                not fits_in_budget(bytes_per_pair * len(self.reshaped) * len(self.indices), fraction=0.25):
+            # The ranks of every batch are computed when it is sampled.
+            self.input_max_rank, self.rank_squares = None, None
+            return
+
+        # Compact ranks (int16 for up to 32768 reference points), and weights in the compute dtype.
+        self.input_max_rank = torch.from_numpy(self.compute_input_ranks(self.reshaped)).to(self.torch_device)
+        self.rank_squares = (self.input_max_rank.float() ** 2).to(self.compute_dtype)
+
+    def compute_input_ranks(self, pixels):
+        """Rank of every reference point by distance from every pixel, the maximum of the cosine and chebyshev ranks."""
+        return distance_ranks(pixels, self.reference_points)
+
+    def get_input_ranks(self, rows):
+        """Input ranks and rank weights of the pixel rows (a LongTensor), from the cache or computed on the fly."""
+        if self.input_max_rank is not None:
+            return self.input_max_rank[rows], self.rank_squares[rows]
+        input_max_rank = torch.from_numpy(self.compute_input_ranks(self.reshaped[rows.cpu().numpy()]))
+        input_max_rank = input_max_rank.to(rows.device)
+        return input_max_rank, (input_max_rank.float() ** 2).to(self.compute_dtype)
+
+    def embed(self, rows=None):
+        """Embeddings of the pixel rows (a LongTensor), or of all the pixels.
+        In mini batch mode the lookup has a sparse gradient, so only these rows are updated."""
+        if rows is None:
+            return self.visualization
+        return torch.nn.functional.embedding(rows, self.visualization, sparse=self.batch_size is not None)
+
+    def predict(self, img, callback=None, every=None):
+        """
+        callback: optional callback(epoch, frame), called with every frame of predict_iter.
+        every: also render a frame every this many epochs. By default only the final visualization is rendered.
+        """
+        for epoch, output in self.predict_iter(img, every):
+            if callback is not None:
+                callback(epoch, output)
         return output
 
+    def predict_iter(self, img, every=None):
+        """Optimizes the visualization of img, and yields (epoch, frame) every `every` epochs and after the last one.
+        Frames are rendered (copied from the device, normalized and converted to RGB) only when they are yielded.
+        With a pyramid, only the full resolution epochs are counted and rendered."""
+        self.set_image(img, self.optimize_pyramid(img) if self.pyramid else None)
+        self.epochs_used = 0
+        for epoch in range(self.num_epochs):
+            loss = self.optimize_embeddings()
+            self.epochs_used = epoch + 1
+            converged = self.converged(loss)
+            if converged or epoch == self.num_epochs - 1 or (every is not None and (epoch + 1) % every == 0):
+                yield epoch, self.render()
+            if converged:
+                break
+
     def __call__(self, img):
         return self.predict(img)
 
-    def get_loss(self):
-        reference_points = self.visualization[self.indices]
-        output_distances = torch.cdist(self.visualization, reference_points)
+    def get_loss(self, rows=None):
+        """
+        rows: optional LongTensor of the pixels in the mini batch. By default the loss is over all the pixels.
+        """
+        visualization = self.embed(rows)
+        reference_points = self.embed(self.reference_rows)
+        output_distances = torch.cdist(visualization, reference_points)
         output_ranks = torchsort.soft_rank(
             output_distances,
             regularization_strength=self.regularization_strength)
+        if rows is None:
+            input_max_rank, rank_squares, mask = self.input_max_rank, self.rank_squares, self.mask
+        else:
+            input_max_rank, rank_squares = self.get_input_ranks(rows)
+            mask = self.mask[rows]
 
         saliency = self.loss_saliency(
             output_ranks,
-            self.input_max_rank,
+            input_max_rank,
             torch.ones_like(output_ranks))
-        saliency = (saliency * self.mask[:,
-                                         None] * self.rank_squares).sum() / (self.mask[:,
-                                                                                       None] * self.rank_squares).sum()
+        # Promoted to float32, bfloat16 weights only save memory.
+        weights = mask[:, None] * rank_squares
+        saliency = (saliency * weights).sum(dtype=torch.float32) / weights.sum(dtype=torch.float32)
 
         if self.similarity_reg > 0:
+            orig = self.orig if rows is None else self.orig[rows]
             saliency = saliency + self.similarity_reg * \
-                torch.nn.MSELoss()(self.visualization, self.orig)
+                torch.nn.MSELoss()(visualization, orig)
 
         return saliency
 
     def optimize_embeddings(self):
-        self.optim.zero_grad()
-        loss = self.get_loss()
-        loss.backward()
-        self.optim.step()
+        """One epoch. Returns the loss, averaged over the mini batches."""
+        if self.batch_size is None:
+            self.optim.zero_grad()
+            loss = self.loss_step()
+            loss.backward()
+            self.optim.step()
+            return loss.detach()
+
+        permutation = self.tissue_rows[torch.randperm(len(self.tissue_rows), device=self.tissue_rows.device)]
+        total = 0
+        for start in range(0, len(permutation), self.batch_size):
+            self.optim.zero_grad()
+            loss = self.loss_step(permutation[start: start + self.batch_size])
+            loss.backward()
+            self.optim.step()
+            total = total + loss.detach()
+        return total / max(1, -(-len(permutation) // self.batch_size))
+
+    def optimize_pyramid(self, img):
+        """Runs the coarse levels of the pyramid, and returns the initial embedding for the full resolution."""
+        factors = list(self.pyramid) + [1]
+        if any(coarse % fine for coarse, fine in zip(factors[:-1], factors[1:])):
+            raise Exception(f"Every pyramid factor should be a multiple of the next one: {self.pyramid}")
+
+        # The [H, W] of every level, like downsample_cube outputs.
+        shapes = [(-(-img.shape[0] // factor), -(-img.shape[1] // factor)) for factor in factors]
+        embedding = None
+        if isinstance(self.init, np.ndarray):
+            embedding = cv2.resize(np.float32(self.init) / 255 * 10 - 5, (shapes[0][1], shapes[0][0]),
+                                   interpolation=cv2.INTER_AREA)
+
+        self.pyramid_epochs_used = []
+        for level, factor in enumerate(factors[:-1]):
+            coarse = downsample_cube(img, factor)
+            self.set_image(coarse, embedding)
+            self.pyramid_epochs_used.append(0)
+            for _ in range(self.pyramid_epochs):
+                self.pyramid_epochs_used[-1] += 1
+                if self.converged(self.optimize_embeddings()):
+                    break
+            embedding = self.visualization.detach().cpu().numpy().reshape(coarse.shape[0], coarse.shape[1], -1)
+            embedding = upsample_embedding(embedding, factor // factors[level + 1], shapes[level + 1])
+        return embedding
 
     def compute_epoch(self):
         self.optimize_embeddings()
+        return self.render()
 
-        x = self.visualization.detach().cpu().numpy()
+    def render(self):
+        """The current embedding as an RGB uint8 image."""
+        # On the cpu the numpy array shares the storage of the parameter, mask a copy
+        x = self.visualization.detach().cpu().numpy().copy()
         x[self.mask_np == 0] = 0
         x = x.reshape((self.img.shape[0], self.img.shape[1], 3))
         x = normalize(x)
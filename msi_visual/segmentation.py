@@ -2,6 +2,8 @@ import numpy as np
 import torch
 from msi_visual.visualizations import visualizations_from_explanations
 from matplotlib import pyplot as plt
+from msi_visual.preprocessing import preprocess_pixels
+from msi_visual.sparse import dense_rows
 
 
 class SegmentationDataset:
@@ -49,11 +51,13 @@ def load_model(model_path="models/segmentation.pth"):
     return model
 
 
-def preprocess(img):
-    processed = img[:, :, : 5005]
-    processed = processed / (1e-6 + np.sum(img, axis=-1)[:, :, None])
+def preprocess(img, percentiles=None):
+    processed, _ = preprocess_pixels(img, end_bin=5005, normalization='tic')
+    processed = processed.reshape(img.shape[0], img.shape[1], -1)
+    if percentiles is None:
+        percentiles = np.percentile(processed, 99, axis=(0, 1))
     processed = processed / \
-        (1e-6 + np.percentile(processed, 99, axis=(0, 1))[None, None, :])
+        (1e-6 + percentiles[None, None, :])
     processed[processed > 1] = 1
     return processed
 
@@ -75,6 +79,9 @@ def get_visualization(img, output):
 
 
 class DeepLearningSegmentation:
+    # __call__ outputs k x H x W
+    tile_axis = 1
+
     def __init__(
             self,
             model_path="models/segmentation.pth",
@@ -84,9 +91,19 @@ class DeepLearningSegmentation:
         if torch.cuda.is_available():
             self.model = self.model.cuda()
         self.model.eval()
+        self.percentiles = None
+
+    def prepare_tiles(self, img, max_pixels=100000):
+        # The spatial percentiles are global, estimate them from a subset of the rows.
+        step = max(1, int(np.ceil(img.shape[0] * img.shape[1] / max_pixels)))
+        processed, _ = preprocess_pixels(dense_rows(img, slice(None, None, step)), end_bin=5005, normalization='tic')
+        self.percentiles = np.percentile(processed, 99, axis=0)
+
+    def predict_tile(self, img):
+        return self(img, percentiles=self.percentiles)
 
-    def __call__(self, img):
-        processed = preprocess(img)
+    def __call__(self, img, percentiles=None):
+        processed = preprocess(img, percentiles)
         vector = processed.reshape(-1, processed.shape[-1])
         input = torch.Tensor(vector)
         if torch.cuda.is_available():
@@ -0,0 +1,147 @@
+import os
+import multiprocessing
+import numpy as np
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor
+from threadpoolctl import threadpool_limits
+
+
+def _attach_shared_memory(name):
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # Before python 3.13 attaching registers the segment with the resource tracker,
+        # which would destroy it when the worker exits. Only the creating process should own it.
+        from multiprocessing import resource_tracker
+        register = resource_tracker.register
+        resource_tracker.register = lambda *args, **kwargs: None
+        try:
+            return shared_memory.SharedMemory(name=name)
+        finally:
+            resource_tracker.register = register
+
+
+class SharedArray:
+    """A numpy array in shared memory.
+    Pickling it only sends the segment name, so worker processes get a read only view without copying the data."""
+
+    def __init__(self, array):
+        array = np.asarray(array)
+        self.shape, self.dtype = array.shape, array.dtype
+        self.shm = shared_memory.SharedMemory(create=True, size=max(1, array.nbytes))
+        self.owner = True
+        self.array = np.ndarray(self.shape, dtype=self.dtype, buffer=self.shm.buf)
+        self.array[...] = array
+        self.array.flags.writeable = False
+
+    @classmethod
+    def empty(cls, shape, dtype=np.float32):
+        """A writable shared array that the caller fills in place, without an intermediate copy."""
+        shared = cls.__new__(cls)
+        shared.shape, shared.dtype = tuple(shape), np.dtype(dtype)
+        nbytes = int(np.prod(shape)) * shared.dtype.itemsize
+        shared.shm = shared_memory.SharedMemory(create=True, size=max(1, nbytes))
+        shared.owner = True
+        shared.array = np.ndarray(shared.shape, dtype=shared.dtype, buffer=shared.shm.buf)
+        return shared
+
+    def __getstate__(self):
+        return {"name": self.shm.name, "shape": self.shape, "dtype": self.dtype.str}
+
+    def __setstate__(self, state):
+        self.shape, self.dtype = state["shape"], np.dtype(state["dtype"])
+        self.shm = _attach_shared_memory(state["name"])
+        self.owner = False
+        self.array = np.ndarray(self.shape, dtype=self.dtype, buffer=self.shm.buf)
+        self.array.flags.writeable = False
+
+    def close(self):
+        self.array = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+class MemmapArray:
+    """A cube that already lives in a .npy file. Workers open it as a read only memmap."""
+
+    def __init__(self, path):
+        self.path = str(path)
+        self.array = np.load(self.path, mmap_mode='r')
+
+    def __getstate__(self):
+        return {"path": self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state["path"])
+
+    def close(self):
+        self.array = None
+
+
+def share(array):
+    """Wraps an array for zero copy handoff to worker processes.
+    .npy memmaps are passed by path, everything else is copied once into shared memory."""
+    if isinstance(array, (SharedArray, MemmapArray)):
+        return array
+    if isinstance(array, np.memmap) and array.filename is not None and str(array.filename).endswith(".npy"):
+        return MemmapArray(array.filename)
+    return SharedArray(array)
+
+
+_worker_arrays = {}
+
+
+def _init_worker(arrays, threads_per_worker=None):
+    if threads_per_worker is not None:
+        # The environment variables are read by the OpenMP / BLAS runtimes that are loaded later,
+        # threadpoolctl limits the ones that are already loaded.
+        for name in ("OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS", "NUMBA_NUM_THREADS"):
+            os.environ[name] = str(threads_per_worker)
+        threadpool_limits(threads_per_worker)
+    _worker_arrays.clear()
+    _worker_arrays.update({name: shared.array for name, shared in arrays.items()})
+
+
+def _run_task(func, item):
+    return func(item, **_worker_arrays)
+
+
+class SharedPool:
+    """A process pool whose workers receive large arrays (cubes, masks) through shared memory.
+
+    with SharedPool(n_jobs=4, img=img, mask=mask) as pool:
+        results = pool.map(func, items)
+
+    calls func(item, img=img, mask=mask) in the workers. func has to be a module level function,
+    and the main script has to be importable (if __name__ == "__main__").
+    threads_per_worker caps the OpenMP / BLAS threads of every worker, so that the workers do not oversubscribe the cores.
+    """
+
+    def __init__(self, n_jobs=None, threads_per_worker=None, **arrays):
+        self.n_jobs = n_jobs or os.cpu_count()
+        self.arrays = {name: share(array) for name, array in arrays.items()}
+        self.owned = [self.arrays[name] for name in arrays if self.arrays[name] is not arrays[name]]
+        # Forking a process that already ran parallel numba kernels can deadlock (TBB threading layer),
+        # so workers are started from a clean server process.
+        methods = multiprocessing.get_all_start_methods()
+        context = multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+        self.executor = ProcessPoolExecutor(max_workers=self.n_jobs,
+                                            mp_context=context,
+                                            initializer=_init_worker,
+                                            initargs=(self.arrays, threads_per_worker))
+
+    def map(self, func, items):
+        futures = [self.executor.submit(_run_task, func, item) for item in items]
+        return [future.result() for future in futures]
+
+    def close(self):
+        self.executor.shutdown()
+        for shared in self.owned:
+            shared.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
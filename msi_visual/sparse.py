@@ -0,0 +1,98 @@
+import numpy as np
+import scipy.sparse as sp
+from msi_visual.memory import iter_chunks
+
+
+class SparseCube:
+    """An MSI cube stored as a CSR matrix of shape [H*W, D], for peak picked or nonzero extractions
+    where most of the m/z bins of a pixel are 0. Memory scales with the number of nonzeros.
+
+    Slicing image rows (cube[rows]) gives a SparseCube of those rows, like slicing a dense cube,
+    so the tiled and chunked code paths work unchanged.
+    """
+
+    def __init__(self, matrix, shape):
+        self.matrix = sp.csr_matrix(matrix)
+        self.shape = tuple(int(s) for s in shape)
+        self.ndim = 3
+        if self.matrix.shape != (self.shape[0] * self.shape[1], self.shape[2]):
+            raise ValueError(f"A {self.matrix.shape} matrix is not a {self.shape} cube")
+
+    def __repr__(self):
+        return f"SparseCube {self.shape} nnz={self.nnz}"
+
+    @property
+    def dtype(self):
+        return self.matrix.dtype
+
+    @property
+    def nnz(self):
+        return self.matrix.nnz
+
+    @classmethod
+    def from_dense(cls, img):
+        """Converts a dense (possibly memmapped) cube in row chunks."""
+        H, W, D = img.shape
+        blocks = [sp.csr_matrix(np.asarray(img[rows]).reshape(-1, D))
+                  for rows in iter_chunks(H, W * D * img.dtype.itemsize)]
+        return cls(sp.vstack(blocks, format='csr'), img.shape)
+
+    def __getitem__(self, rows):
+        if not isinstance(rows, slice):
+            raise TypeError("SparseCube only supports slicing image rows")
+        H, W, D = self.shape
+        start, stop, step = rows.indices(H)
+        if step == 1:
+            matrix = self.matrix[start * W: max(start, stop) * W]
+        else:
+            image_rows = np.arange(start, stop, step)
+            matrix = self.matrix[(image_rows[:, None] * W + np.arange(W)[None, :]).reshape(-1)]
+        return SparseCube(matrix, (matrix.shape[0] // max(1, W), W, D))
+
+    def toarray(self):
+        return self.matrix.toarray().reshape(self.shape)
+
+    def save(self, path):
+        np.savez(path, data=self.matrix.data, indices=self.matrix.indices,
+                 indptr=self.matrix.indptr, shape=np.int64(self.shape))
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as f:
+            shape = f["shape"]
+            matrix = sp.csr_matrix((f["data"], f["indices"], f["indptr"]),
+                                   shape=(shape[0] * shape[1], shape[2]))
+        return cls(matrix, shape)
+
+
+def is_sparse(x):
+    return isinstance(x, SparseCube) or sp.issparse(x)
+
+
+def read_rows(img, rows):
+    """img[rows] as something the pixel kernels can read: an ndarray, or a SparseCube."""
+    if isinstance(img, SparseCube):
+        return img[rows]
+    return np.asarray(img[rows])
+
+
+def dense_rows(img, rows):
+    """img[rows] as a dense ndarray, for the methods that only take dense cubes."""
+    if isinstance(img, SparseCube):
+        return img[rows].toarray()
+    return np.asarray(img[rows])
+
+
+def to_dense(vector):
+    """Densifies a sparse pixel matrix, for the models that do not take sparse input."""
+    if sp.issparse(vector):
+        return vector.toarray()
+    return vector
+
+
+def stack_rows(vectors):
+    """np.concatenate of pixel matrices along the rows, that keeps CSR matrices sparse."""
+    vectors = list(vectors)
+    if any(sp.issparse(v) for v in vectors):
+        return sp.vstack(vectors, format='csr')
+    return np.concatenate(vectors, axis=0)
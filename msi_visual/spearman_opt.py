@@ -5,6 +5,9 @@ from PIL import Image
 import tqdm
 import torchsort
 import cv2
+from msi_visual.ranks import distance_ranks
+from msi_visual.devices import get_device, get_compute_dtype, set_num_threads
+from msi_visual.convergence import sample_validation_pairs, hard_ranks
 
 from msi_visual.percentile_ratio import TOP3
 from sklearn.cluster import KMeans, kmeans_plusplus
@@ -19,13 +22,32 @@ class SpearmanOptimization:
             sampling="coreset",
             num_epochs=200,
             init="random",
-            similarity_reg=0):
+            similarity_reg=0,
+            device=None,
+            num_threads=None,
+            compile=False,
+            dtype="float32",
+            convergence=None):
+        """
+        device: torch device name, like 'cpu' or 'cuda'. By default cuda when it is available.
+        num_threads: number of torch CPU threads.
+        compile: torch.compile the loss.
+        dtype: 'float32', or 'bfloat16' to store the pixels x references cosine distances in half the memory
+               (about 3 significant digits). The ranks and the correlation are always computed in float32.
+        convergence: optional ConvergenceMonitor, to stop before num_epochs once the loss plateaus.
+                     The epochs that were run are in epochs_used.
+        """
         self.num_epochs = num_epochs
         self.regularization_strength = regularization_strength
         self.sampling = sampling
         self.number_of_points = number_of_points
         self.init = init
         self.similarity_reg = similarity_reg
+        self.device = device
+        self.num_threads = num_threads
+        self.compile = compile
+        self.dtype = dtype
+        self.convergence = convergence
 
     def __repr__(self):
         return f"Spearman Optimization: num_epochs: {self.num_epochs} regularization_strength: {self.regularization_strength} \
@@ -68,6 +90,9 @@ class SpearmanOptimization:
             return np.random.choice(N, Np, p=q)
 
     def set_image(self, img):
+        self.torch_device = get_device(self.device)
+        self.compute_dtype = get_compute_dtype(self.dtype)
+        set_num_threads(self.num_threads)
         self.img = img
         self.reshaped = self.img.reshape(
             self.img.shape[0] * self.img.shape[1], -1)
@@ -89,8 +114,7 @@ class SpearmanOptimization:
         else:
             raise Exception(f"{self.init} not supported as initialization")
 
-        if torch.cuda.is_available():
-            self.visualization = self.visualization.cuda()
+        self.visualization = self.visualization.to(self.torch_device)
 
         if self.similarity_reg > 0:
             self.orig = self.visualization.clone()
@@ -102,7 +126,38 @@ class SpearmanOptimization:
         self.loss_saliency = torch.nn.MarginRankingLoss(
             margin=-delta, reduction='none')
         self.mask_np = self.reshaped.max(axis=-1) > 0
-        self.mask = torch.from_numpy(self.mask_np).float().cuda()
+        self.mask = torch.from_numpy(self.mask_np).float().to(self.torch_device)
+        self.loss_step = torch.compile(self.get_loss) if self.compile else self.get_loss
+
+        if self.convergence is not None:
+            self.convergence.reset()
+            if self.convergence.validation_pixels:
+                self.set_validation_pairs()
+
+    def set_validation_pairs(self):
+        """Held out pixels and reference points for the convergence metric, with their input cosine ranks."""
+        pixel_rows, reference_rows = sample_validation_pairs(self.mask_np, self.indices,
+                                                             self.convergence.validation_pixels,
+                                                             self.convergence.validation_points)
+        _, cosine = distance_ranks(self.reshaped[pixel_rows], self.reshaped[reference_rows], return_cosine=True)
+        self.validation_rows = torch.from_numpy(pixel_rows).to(self.torch_device)
+        self.validation_references = torch.from_numpy(reference_rows).to(self.torch_device)
+        self.validation_cosine = torch.from_numpy(cosine).to(self.torch_device).float()
+
+    def validation_loss(self):
+        """Minus the spearman correlation on the held out pairs, with hard output ranks."""
+        with torch.no_grad():
+            output_distances = torch.cdist(self.visualization[self.validation_rows],
+                                           self.visualization[self.validation_references])
+            return float(-self.spearmanr(hard_ranks(output_distances).float(), self.validation_cosine))
+
+    def converged(self, loss):
+        """Feeds the epoch to the convergence monitor. Returns True when the optimization should stop."""
+        if self.convergence is None:
+            return False
+        if self.convergence.validation_pixels:
+            return self.convergence.update(self.validation_loss())
+        return self.convergence.update(loss)
 
     def resample(self, number_of_points):
         sampled_indices = self.get_reference_points(
@@ -111,28 +166,35 @@ class SpearmanOptimization:
             i for i in sampled_indices if self.reshaped[i, :].max(axis=-1) > 0]
 
         reference_points = self.reshaped[self.indices, :]
-        cosine = pairwise_distances(
-            self.reshaped,
-            reference_points,
-            metric='cosine')
-        chebyshev = pairwise_distances(
-            self.reshaped, reference_points, metric='chebyshev')
-
-        cosine = cosine.argsort().argsort()
-        chebyshev = chebyshev.argsort().argsort()
-        self.cosine = torch.from_numpy(cosine).float()
-        self.input_max_rank = torch.from_numpy(np.maximum(chebyshev, cosine))
-        if torch.cuda.is_available():
-            self.input_max_rank = self.input_max_rank.cuda()
-            self.cosine = self.cosine.cuda()
-        self.rank_squares = self.input_max_rank ** 2
-
-    def predict(self, img):
-        self.set_image(img)
-        for _ in range(self.num_epochs):
-            output = self.compute_epoch()
+        input_max_rank, cosine = distance_ranks(self.reshaped, reference_points, return_cosine=True)
+        self.cosine = torch.from_numpy(cosine).to(self.torch_device, self.compute_dtype)
+        self.input_max_rank = torch.from_numpy(input_max_rank).to(self.torch_device)
+        self.rank_squares = self.input_max_rank.float() ** 2
+
+    def predict(self, img, callback=None, every=None):
+        """
+        callback: optional callback(epoch, frame), called with every frame of predict_iter.
+        every: also render a frame every this many epochs. By default only the final visualization is rendered.
+        """
+        for epoch, output in self.predict_iter(img, every):
+            if callback is not None:
+                callback(epoch, output)
         return output
 
+    def predict_iter(self, img, every=None):
+        """Optimizes the visualization of img, and yields (epoch, frame) every `every` epochs and after the last one.
+        Frames are rendered (copied from the device, normalized and converted to RGB) only when they are yielded."""
+        self.set_image(img)
+        self.epochs_used = 0
+        for epoch in range(self.num_epochs):
+            loss = self.optimize_embeddings()
+            self.epochs_used = epoch + 1
+            converged = self.converged(loss)
+            if converged or epoch == self.num_epochs - 1 or (every is not None and (epoch + 1) % every == 0):
+                yield epoch, self.render()
+            if converged:
+                break
+
     def __call__(self, img):
         return self.predict(img)
 
@@ -146,20 +208,31 @@ class SpearmanOptimization:
         target = target / target.norm()
         return (pred * target).sum()
 
-    def compute_epoch(self):
+    def get_loss(self):
         reference_points = self.visualization[self.indices]
         output_distances = torch.cdist(self.visualization, reference_points)
         output_ranks = torchsort.soft_rank(
             output_distances,
             regularization_strength=self.regularization_strength)
+        return -self.spearmanr(output_ranks, self.cosine.float())
 
-        loss = -self.spearmanr(output_ranks, self.cosine)
+    def optimize_embeddings(self):
+        """One epoch. Returns the loss."""
+        loss = self.loss_step()
 
         self.optim.zero_grad()
         loss.backward()
         self.optim.step()
+        return loss.detach()
+
+    def compute_epoch(self):
+        self.optimize_embeddings()
+        return self.render()
 
-        x = self.visualization.detach().cpu().numpy()
+    def render(self):
+        """The current embedding as an RGB uint8 image."""
+        # On the cpu the numpy array shares the storage of the parameter, mask a copy
+        x = self.visualization.detach().cpu().numpy().copy()
         x[self.mask_np == 0] = 0
         x = x.reshape((self.img.shape[0], self.img.shape[1], 3))
 
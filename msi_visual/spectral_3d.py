@@ -2,5 +2,5 @@ from msi_visual.base_dim_reduction import BaseDimReductionWithoutFit
 from sklearn.manifold import SpectralEmbedding
 
 class Spectral3D(BaseDimReductionWithoutFit):
-    def __init__(self):
-        super().__init__(model=SpectralEmbedding(n_components=3), name="SpectralEmbedding3D")
\ No newline at end of file
+    def __init__(self, landmarks=None):
+        super().__init__(model=SpectralEmbedding(n_components=3), name="SpectralEmbedding3D", landmarks=landmarks)
\ No newline at end of file
@@ -0,0 +1,55 @@
+import numpy as np
+import numba
+
+MOMENTS = ["mean", "std", "skewness", "entropy", "raw_mean"]
+
+
+@numba.njit(parallel=True, fastmath=True, cache=True)
+def _spectral_moments_kernel(img, out, with_entropy):
+    H, W, C = img.shape
+    for i in numba.prange(H * W):
+        y, x = i // W, i % W
+        total = 0.0
+        weighted = 0.0
+        for c in range(C):
+            total += img[y, x, c]
+            weighted += img[y, x, c] * c
+        out[y, x, 4] = weighted / C
+        if total <= 0:
+            continue
+
+        # The spectrum is TIC normalized on the fly, p = intensity / total
+        mean = weighted / total
+        variance = 0.0
+        third = 0.0
+        entropy = 0.0
+        for c in range(C):
+            p = img[y, x, c] / total
+            if p > 0:
+                d = c - mean
+                variance += p * d * d
+                third += p * d * d * d
+                if with_entropy:
+                    entropy -= p * np.log(p)
+        std = np.sqrt(variance)
+        out[y, x, 0] = mean
+        out[y, x, 1] = std
+        if std > 0:
+            out[y, x, 2] = third / (std * std * std)
+        out[y, x, 3] = entropy
+
+
+def spectral_moments(img, entropy=True):
+    """Moments of every pixel's TIC normalized spectrum over the m/z bin index, in one streaming pass.
+
+    Args:
+        img: ndarray of shape [H, W, D]
+        entropy: compute the entropy, a log of every nonzero value. Otherwise it is left 0.
+    Returns:
+        dict from each of MOMENTS (mean m/z, std, skewness, entropy) to a float32 [H, W] image.
+        raw_mean is the mean of intensity x bin index over the bins, without the TIC normalization.
+        Pixels without any intensity get 0.
+    """
+    out = np.zeros((img.shape[0], img.shape[1], len(MOMENTS)), dtype=np.float32)
+    _spectral_moments_kernel(img, out, entropy)
+    return {name: out[:, :, i] for i, name in enumerate(MOMENTS)}
@@ -0,0 +1,68 @@
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from msi_visual.memory import chunk_size
+from msi_visual.sparse import SparseCube, read_rows, dense_rows
+
+
+def load_cube(path):
+    """Opens an extracted .npy cube as a read only memmap, without reading it into RAM.
+    .npz files saved by SparseCube.save are loaded as a SparseCube."""
+    if str(path).endswith(".npz"):
+        return SparseCube.load(path)
+    return np.load(path, mmap_mode='r')
+
+
+class TileExecutor:
+    """Streams row blocks of a (possibly memmapped) cube through a pixel-wise method and stitches the outputs.
+
+    Methods can implement these optional hooks:
+        prepare_tiles(img): a reduce pass over the whole cube before the tiles are processed.
+        predict_tile(tile): the per-pixel part of the method. Defaults to predict, or calling the method.
+        finalize_tiles(output): global steps on the stitched output, like the final percentile scaling.
+        tile_axis: the output axis that corresponds to the image rows (0 for H x W x C, 1 for k x H x W).
+        sparse_tiles: True if predict_tile takes SparseCube tiles. The other methods get dense tiles of sparse cubes.
+    """
+
+    def __init__(self, method, rows_per_tile=None, n_jobs=1):
+        self.method = method
+        self.rows_per_tile = rows_per_tile
+        self.n_jobs = n_jobs
+
+    def __repr__(self):
+        return f"Tiled {self.method}"
+
+    def get_tiles(self, img):
+        rows_per_tile = self.rows_per_tile
+        if rows_per_tile is None:
+            # Leave room for the per tile temporaries of every worker.
+            rows_per_tile = chunk_size(4 * img.shape[1] * img.shape[2] * 4,
+                                       img.shape[0], fraction=0.5 / self.n_jobs)
+        return [slice(start, min(img.shape[0], start + rows_per_tile))
+                for start in range(0, img.shape[0], rows_per_tile)]
+
+    def __call__(self, img):
+        if isinstance(img, str):
+            img = load_cube(img)
+
+        if hasattr(self.method, 'prepare_tiles'):
+            self.method.prepare_tiles(img)
+
+        if hasattr(self.method, 'predict_tile'):
+            predict = self.method.predict_tile
+        elif hasattr(self.method, 'predict'):
+            predict = self.method.predict
+        else:
+            predict = self.method
+
+        read = read_rows if getattr(self.method, 'sparse_tiles', False) else dense_rows
+        tiles = self.get_tiles(img)
+        if self.n_jobs > 1:
+            with ThreadPoolExecutor(self.n_jobs) as pool:
+                outputs = list(pool.map(lambda rows: predict(read(img, rows)), tiles))
+        else:
+            outputs = [predict(read(img, rows)) for rows in tiles]
+
+        output = np.concatenate(outputs, axis=getattr(self.method, 'tile_axis', 0))
+        if hasattr(self.method, 'finalize_tiles'):
+            output = self.method.finalize_tiles(output)
+        return output
@@ -1,7 +1,18 @@
 from msi_visual.base_dim_reduction import BaseDimReductionWithoutFit
+from msi_visual.neighbors import get_knn_graph
 import trimap
 
 
 class Trimap3D(BaseDimReductionWithoutFit):
-    def __init__(self):
-        super().__init__(model=trimap.TRIMAP(n_dims=3), name="Trimap")
\ No newline at end of file
+    def __init__(self, landmarks=None):
+        super().__init__(model=trimap.TRIMAP(n_dims=3), name="Trimap", landmarks=landmarks)
+
+    def fit_transform(self, vector):
+        # TriMap samples its triplets from the n_inliers + 50 nearest neighbors, including the point itself.
+        k = min(self.model.n_inliers + 50, len(vector)) - 1
+        self.model.knn_tuple = get_knn_graph(vector, k, 'euclidean').neighbors(k)
+        try:
+            return self.model.fit_transform(vector)
+        finally:
+            # TRIMAP keeps the triplets of the last fit and would reuse them on the next image.
+            self.model.knn_tuple, self.model.triplets, self.model.weights = None, None, None
\ No newline at end of file
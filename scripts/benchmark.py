@@ -5,6 +5,7 @@ from msi_visual.nonparametric_umap  import MSINonParametricUMAP
 from msi_visual.percentile_ratio import TOP3, PercentileRatio
 from msi_visual.metrics import MSIVisualizationMetrics
 from msi_visual.normalization import total_ion_count
+from msi_visual.shared_memory import SharedPool
 from PIL import Image
 import tqdm
 import os
@@ -14,7 +15,6 @@ import numpy as np
 import glob
 from pathlib import Path
 import random
-import time
 from collections import defaultdict
 import pandas as pd
 import torch
@@ -23,10 +23,23 @@ def get_args():
     parser = argparse.ArgumentParser()
     parser.add_argument('--dir', type=str, required=True)
     parser.add_argument('--dst', type=str, required=True)
+    parser.add_argument('--n_jobs', type=int, default=1,
+                        help='Number of processes that run methods concurrently on the same image')
     args = parser.parse_args()
     return args
 
 
+def run_method(item, img):
+    name, method = item
+    method._trained = False
+    t0 = time.time()
+    visualization = method(img)
+    t = time.time() - t0
+    random.seed(0)
+    metrics = MSIVisualizationMetrics(img, visualization).get_metrics()
+    return visualization, t, metrics
+
+
 if __name__ == "__main__":
     args = get_args()
     paths = glob.glob(str(Path(args.dir) / "*/*.npy"))
@@ -91,38 +104,33 @@ if __name__ == "__main__":
         img = total_ion_count(img)
         visualizations = {}
         metrics = {}
-        for name, method in tqdm.tqdm(methods):
-            method._trained = False
-            exists = False     
-            dst_path = str(Path(args.dst) / f"{index}_{name}.png")
-            
+        pending = []
+        for name, method in methods:
             if len(result2_csv[(result2_csv["method"] == name) & (result2_csv["path"] == path)]) > 0:
                 print(f"Existing {name} {path}")
             else:
-                #if os.path.exists(dst_path):
-                #    exists = True
-                #    visualizations[name] = np.array(Image.open(dst_path))
-                #    print(f'Existing {dst_path}')
-                #else:
-                t0 = time.time()
-                visualizations[name] = method(img)
-                t = time.time() - t0
-                random.seed(0)
-                metrics[name] = MSIVisualizationMetrics(
-                    img, visualizations[name]).get_metrics()
-                print(index, name, metrics[name])
-
-
-                result["method"].append(name)
-                result["path"].append(path)
-                #if not exists:
-                result["time"].append(t)
-                for m in metrics[name]:
-                    result[m].append(metrics[name][m])
-
-
-                if not exists:
-                    Image.fromarray(visualizations[name]).save(dst_path)
+                pending.append((name, method))
+
+        if args.n_jobs > 1:
+            # The image is shared with the workers instead of being pickled to each one.
+            with SharedPool(args.n_jobs, img=img) as pool:
+                outputs = pool.map(run_method, pending)
+        else:
+            outputs = [run_method(item, img) for item in tqdm.tqdm(pending)]
+
+        for (name, method), (visualization, t, method_metrics) in zip(pending, outputs):
+            dst_path = str(Path(args.dst) / f"{index}_{name}.png")
+            visualizations[name] = visualization
+            metrics[name] = method_metrics
+            print(index, name, metrics[name])
+
+            result["method"].append(name)
+            result["path"].append(path)
+            result["time"].append(t)
+            for m in metrics[name]:
+                result[m].append(metrics[name][m])
+
+            Image.fromarray(visualizations[name]).save(dst_path)
 
         result_csv = pd.DataFrame.from_dict(result)
         result_csv.to_csv(str(Path(args.dst) / "benchmark_new.csv"), index=False)
@@ -0,0 +1,96 @@
+from msi_visual.saliency_opt import SaliencyOptimization
+import argparse
+import time
+import numpy as np
+import pandas as pd
+import torch
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input_path', type=str, default=None,
+                        help='Optional .npy cube. By default synthetic cubes of every --sizes are used')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[128, 256, 512],
+                        help='Side lengths of the synthetic square cubes')
+    parser.add_argument('--bins', type=int, default=1000,
+                        help='Number of m/z bins of the synthetic cubes')
+    parser.add_argument('--number_of_points', type=int, default=500)
+    parser.add_argument('--num_epochs', type=int, default=10)
+    parser.add_argument('--device', type=str, default='cpu')
+    parser.add_argument('--num_threads', type=int, nargs='+', default=[None],
+                        help='Torch thread counts to compare')
+    parser.add_argument('--dtypes', type=str, nargs='+', default=['float32', 'bfloat16'])
+    parser.add_argument('--compile', action='store_true',
+                        help='Also measure with torch.compile of the loss')
+    parser.add_argument('--batch_size', type=int, default=None)
+    parser.add_argument('--output', type=str, default=None,
+                        help='Optional .csv for the results')
+    args = parser.parse_args()
+    return args
+
+
+def synthetic_cube(size, bins, seed=0):
+    """A few random spectra, mixed smoothly over the image, with sparse noise."""
+    rng = np.random.default_rng(seed)
+    spectra = rng.random((8, bins)).astype(np.float32) * (rng.random((8, bins)) < 0.1)
+    y, x = np.mgrid[0:size, 0:size] / size
+    weights = np.stack([np.sin((i + 1) * np.pi * x) * np.cos((i % 3 + 1) * np.pi * y) for i in range(8)], axis=-1)
+    weights = np.maximum(weights, 0).astype(np.float32)
+    return weights @ spectra + 0.01 * rng.random((size, size, bins), dtype=np.float32)
+
+
+def float32_loss(method):
+    """The loss of the final embedding with float32 rank weights, to compare the quality of the dtypes."""
+    with torch.no_grad():
+        if method.input_max_rank is None:
+            # Mini batches without a rank cache, the mean of the batch losses
+            batches = torch.split(method.tissue_rows, method.batch_size)
+            return float(sum(method.get_loss(rows) * len(rows) for rows in batches) / len(method.tissue_rows))
+        rank_squares = method.rank_squares
+        method.rank_squares = method.input_max_rank.float() ** 2
+        loss = float(method.get_loss())
+        method.rank_squares = rank_squares
+        return loss
+
+
+if __name__ == "__main__":
+    args = get_args()
+    if args.input_path is not None:
+        cubes = [(args.input_path, np.load(args.input_path))]
+    else:
+        cubes = [(f"{size}x{size}x{args.bins}", synthetic_cube(size, args.bins)) for size in args.sizes]
+
+    compile_options = [False, True] if args.compile else [False]
+    rows = []
+    for name, img in cubes:
+        for num_threads in args.num_threads:
+            for dtype in args.dtypes:
+                for compile in compile_options:
+                    torch.manual_seed(0)
+                    np.random.seed(0)
+                    method = SaliencyOptimization(number_of_points=args.number_of_points, num_epochs=args.num_epochs,
+                                                  batch_size=args.batch_size, device=args.device,
+                                                  num_threads=num_threads, compile=compile, dtype=dtype)
+                    t0 = time.time()
+                    method.set_image(img)
+                    setup_time = time.time() - t0
+
+                    # The first epoch includes the compilation, it is timed separately.
+                    t0 = time.time()
+                    method.optimize_embeddings()
+                    first_epoch = time.time() - t0
+
+                    t0 = time.time()
+                    for _ in range(args.num_epochs):
+                        method.optimize_embeddings()
+                    epochs_per_second = args.num_epochs / (time.time() - t0)
+
+                    rows.append({"cube": name, "threads": torch.get_num_threads(), "dtype": dtype,
+                                 "compile": compile, "setup_time": setup_time, "first_epoch": first_epoch,
+                                 "epochs_per_second": epochs_per_second, "final_loss": float32_loss(method)})
+                    print(rows[-1])
+
+    results = pd.DataFrame(rows)
+    print(results.to_string(index=False))
+    if args.output is not None:
+        results.to_csv(args.output, index=False)
@@ -1,4 +1,4 @@
-from sklearn.decomposition import NMF, non_negative_factorization
+from sklearn.decomposition import NMF
 import matplotlib
 from matplotlib import pyplot as plt
 import cv2
@@ -19,6 +19,7 @@ import matplotlib.patches as mpatches
 from sklearn.metrics.pairwise import cosine_similarity
 from component_UMAP  import get_UMAP 
 from visualizations import get_colors, show_factorization_on_image
+from msi_visual.nnls import nnls_projection
 warnings.filterwarnings('ignore')
 
 def get_unsupervised_decomposition(path: str, 
@@ -27,7 +28,8 @@ def get_unsupervised_decomposition(path: str,
                                    start_mz: int = 300,
                                    consistent_coloring: bool = True,
                                    mask: Optional[np.ndarray] = None,
-                                   do_subsegmentation: bool = False):
+                                   do_subsegmentation: bool = False,
+                                   fit_pixels: Optional[int] = None):
     name = pathlib.Path(path).stem
     img = np.load(path)
     img = np.float32(img)
@@ -41,11 +43,19 @@ def get_unsupervised_decomposition(path: str,
 
     if do_subsegmentation:
         model = NMF(n_components=NUM_COMPONENTS, init='random', random_state=0)
-        W = model.fit_transform(vector)
-        H = model.components_
+        if fit_pixels is not None and fit_pixels < len(vector):
+            # Learn H on a random subsample of the tissue pixels, and project all the pixels on it.
+            tissue = np.flatnonzero(vector.max(axis=-1) > 0)
+            subset = np.random.default_rng(0).choice(tissue, min(fit_pixels, len(tissue)), replace=False)
+            model.fit(vector[subset])
+            H = model.components_
+            W = nnls_projection(vector, H)
+        else:
+            W = model.fit_transform(vector)
+            H = model.components_
     else:
         H = np.load("h_cosegmentation.npy")
-        W, H, n_iter = non_negative_factorization(vector, H=H, W=None, n_components=NUM_COMPONENTS, update_H=False, random_state=0)
+        W = nnls_projection(vector, H)
 
     order, diffs = None, None
     if consistent_coloring:
@@ -154,6 +164,7 @@ if __name__ == '__main__':
     paths = glob.glob(os.path.join(sys.argv[1], "*.npy"))
     NUM_COMPONENTS = int(sys.argv[3])
     do_subsegmentation = int(sys.argv[4])
+    fit_pixels = int(sys.argv[5]) if len(sys.argv) > 5 else None
     colors = get_colors(NUM_COMPONENTS)
     colors = colors + colors
 
@@ -163,7 +174,8 @@ if __name__ == '__main__':
         result = get_unsupervised_decomposition(path,
                                                 NUM_COMPONENTS, 
                                                 colors=colors,
-                                                do_subsegmentation=do_subsegmentation)
+                                                do_subsegmentation=do_subsegmentation,
+                                                fit_pixels=fit_pixels)
         masks = result["masks_per_component"]
         for mask in masks:
             sub_seg = get_unsupervised_decomposition(path,
@@ -1,9 +1,9 @@
 
 from msi_visual import kmeans_segmentation
+from msi_visual.k_sweep import k_sweep
 import glob
 import argparse
 import numpy as np
-from argparse import Namespace
 from pathlib import Path
 import joblib
 import tqdm
@@ -11,15 +11,15 @@ import os
 
 def get_args():
     parser = argparse.ArgumentParser()
-    parser.add_argument('--Percentile Ratioefix', type=str, default='',
-                        help='Percentile Ratioefix to add to all model files')
+    parser.add_argument('--prefix', type=str, default='',
+                        help='Prefix to add to all model files')
     parser.add_argument('--input_path', type=str, required=True,
                         help='.d folder')
     parser.add_argument('--output_path', type=str, required=True,
                         help='Where to store the output .npy files')
     parser.add_argument(
         '--number_of_components',
-        type=list,
+        type=int,
         default=[5, 10, 20, 40, 60, 80, 100],
         nargs='+',
         help='Number of components')
@@ -29,33 +29,52 @@ def get_args():
     parser.add_argument(
         '--end_mz', type=int, default=None,
         help='m/z to stop at')
+    parser.add_argument(
+        '--fit_pixels', type=int, default=None,
+        help='Cluster a random subsample of this many tissue pixels')
+    parser.add_argument(
+        '--mini_batch', action='store_true',
+        help='Cluster with mini batch k-means over chunks of the images')
+    parser.add_argument(
+        '--n_jobs', type=int, default=None,
+        help='Number of k values trained in parallel')
+    parser.add_argument(
+        '--warm_start', action='store_true',
+        help='Start the larger k values from the solution of the smallest one')
     args = parser.parse_args()
     return args
 
-args = get_args()
-
-extraction_args = eval(open(Path(args.input_path) / "args.txt").read())
-bins = extraction_args.bins
-extraction_start_mz = extraction_args.start_mz
+if __name__ == "__main__":
+    args = get_args()
 
-start_bin = int((args.start_mz - extraction_start_mz)*bins)
-if args.end_mz is not None:
-    end_bin = int((args.end_mz-extraction_start_mz)*bins)
-else:
-    end_bin = None
+    extraction_args = eval(open(Path(args.input_path) / "args.txt").read(),
+                           {"Namespace": argparse.Namespace})
+    bins = extraction_args.bins
+    extraction_start_mz = extraction_args.start_mz
 
-paths = glob.glob(args.input_path + "/*.npy")
-images = [np.load(p) for p in paths]
+    start_bin = int((args.start_mz - extraction_start_mz)*bins)
+    if args.end_mz is not None:
+        end_bin = int((args.end_mz-extraction_start_mz)*bins)
+    else:
+        end_bin = None
 
-os.makedirs(args.output_path, exist_ok=True)
+    paths = glob.glob(args.input_path + "/*.npy")
+    # Memmapped, the models read the cubes in row chunks.
+    images = [np.load(p, mmap_mode='r') for p in paths]
 
-for k in tqdm.tqdm(args.number_of_components):
-    seg = kmeans_segmentation.KmeansSegmentation(k=k, normalization='tic', start_bin=start_bin, end_bin=end_bin)
-    seg.fit(images)
-    
-    if len(args.Percentile Ratioefix) > 0:
-        args.Percentile Ratioefix = args.Percentile Ratioefix + "_"
-    name = f"{args.Percentile Ratioefix}bins{bins}_k{k}_startmz{args.start_mz}_endmz{args.end_mz}.joblib"
-    output = Path(args.output_path) / name
+    os.makedirs(args.output_path, exist_ok=True)
+    prefix = args.prefix + "_" if len(args.prefix) > 0 else ""
+    name_format = f"{prefix}bins{bins}_k{{k}}_startmz{args.start_mz}_endmz{args.end_mz}.joblib"
 
-    joblib.dump(seg, output)
\ No newline at end of file
+    if args.mini_batch:
+        # Mini batch fits stream the images, there is no training matrix to share between the k values.
+        for k in tqdm.tqdm(args.number_of_components):
+            seg = kmeans_segmentation.KmeansSegmentation(k=k, start_bin=start_bin, end_bin=end_bin,
+                                                         fit_pixels=args.fit_pixels, mini_batch=args.mini_batch)
+            seg.fit(images)
+            joblib.dump(seg, Path(args.output_path) / name_format.format(k=k))
+    else:
+        summary = k_sweep("kmeans", images, args.number_of_components, args.output_path,
+                          name_format=name_format, start_bin=start_bin, end_bin=end_bin,
+                          fit_pixels=args.fit_pixels, warm_start=args.warm_start, n_jobs=args.n_jobs)
+        print(summary)
\ No newline at end of file
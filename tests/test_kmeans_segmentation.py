@@ -0,0 +1,24 @@
+import numpy as np
+from msi_visual.kmeans_segmentation import KmeansSegmentation
+
+
+def banded_cube(seed=0):
+    # Every cluster covers a band of rows, so the first rows of the image only show one of them
+    rng = np.random.default_rng(seed)
+    spectra = rng.random((6, 40)) * 10
+    labels = np.repeat(np.arange(6), 20)
+    img = spectra[labels][:, None, :] + rng.random((120, 50, 40))
+    return np.float32(img)
+
+
+def inertia(model, img):
+    return -model.model.score(img.reshape(-1, img.shape[-1]))
+
+
+def test_mini_batch_kmeans_is_close_to_the_full_fit():
+    img = banded_cube()
+    full = KmeansSegmentation(k=6)
+    full.fit([img])
+    mini_batch = KmeansSegmentation(k=6, mini_batch=True, batch_size=256)
+    mini_batch.fit([img])
+    assert inertia(mini_batch, img) <= 1.05 * inertia(full, img)
@@ -0,0 +1,15 @@
+import os
+import tempfile
+import numpy as np
+from msi_visual.memory import allocate, memory_budget
+
+
+def test_allocate_leaves_no_temporary_files():
+    before = {name for name in os.listdir(tempfile.gettempdir()) if name.startswith("msi_visual_")}
+    with memory_budget(1024):
+        img = allocate((64, 64, 8), np.uint32)
+    assert isinstance(img, np.memmap)
+    img[3, 4] = 7
+    assert img[3, 4].sum() == 7 * 8
+    after = {name for name in os.listdir(tempfile.gettempdir()) if name.startswith("msi_visual_")}
+    assert after == before
@@ -0,0 +1,36 @@
+import numpy as np
+from zadu.measures import local_continuity_meta_criteria
+from msi_visual.neighbors import get_knn_graph
+
+
+def test_exact_graph_matches_zadu_lcmc_on_large_inputs():
+    # Above 4096 points the default graph is approximate, the metrics ask for an exact one
+    rng = np.random.default_rng(0)
+    data = rng.random((5000, 20)).astype(np.float32)
+    visualization = data[:, :3] + 0.1 * rng.random((5000, 3)).astype(np.float32)
+    k = 30
+
+    data_graph = get_knn_graph(data, k, exact=True)
+    visualization_graph = get_knn_graph(visualization, k, exact=True)
+    assert data_graph.exact and visualization_graph.exact
+    knn_info = (data_graph.neighbors(k, include_self=False)[0], visualization_graph.neighbors(k, include_self=False)[0])
+    shared = local_continuity_meta_criteria.measure(data, visualization, k=k, knn_info=knn_info)
+    expected = local_continuity_meta_criteria.measure(data, visualization, k=k)
+    assert shared["lcmc"] == expected["lcmc"]
+
+
+def test_approximate_graph_is_not_used_for_exact_requests():
+    rng = np.random.default_rng(1)
+    data = rng.random((4200, 8)).astype(np.float32)
+    assert not get_knn_graph(data, 10).exact
+    assert get_knn_graph(data, 10, exact=True).exact
+    assert get_knn_graph(data, 5).exact
+
+
+def test_graphs_of_small_inputs_are_reused(tmp_path):
+    rng = np.random.default_rng(2)
+    data = rng.random((5, 4)).astype(np.float32)
+    graph = get_knn_graph(data, 10, cache_dir=str(tmp_path))
+    assert graph.k == 4
+    assert get_knn_graph(data, 10, cache_dir=str(tmp_path)) is graph
+    assert len(list(tmp_path.iterdir())) == 1
@@ -0,0 +1,25 @@
+import numpy as np
+from msi_visual.nmf_segmentation import NMFSegmentation
+
+
+def synthetic_cube(seed=0):
+    rng = np.random.default_rng(seed)
+    spectra = rng.random((3, 60)) * (rng.random((3, 60)) < 0.4)
+    y, x = np.mgrid[0:80, 0:80] / 80
+    abundances = np.stack([x, y, np.sin(3 * x * y)], axis=-1).clip(0)
+    return np.float32(abundances @ spectra + 0.02 * rng.random((80, 80, 60)))
+
+
+def reconstruction_error(model, img):
+    vector = img.reshape(-1, img.shape[-1])
+    return np.linalg.norm(vector - model.W @ model.H)
+
+
+def test_mini_batch_nmf_is_close_to_the_full_fit():
+    img = synthetic_cube()
+    full = NMFSegmentation(k=3, max_iter=2000)
+    full.fit([img])
+    # Slides have many mini batches per pass, like this small cube with small batches
+    mini_batch = NMFSegmentation(k=3, mini_batch=True, batch_size=16)
+    mini_batch.fit([img])
+    assert reconstruction_error(mini_batch, img) <= 1.05 * reconstruction_error(full, img)
@@ -0,0 +1,23 @@
+import numpy as np
+import pytest
+
+from msi_visual import outliers
+
+
+@pytest.mark.parametrize("method", ["knn", "graph"])
+def test_fewer_tissue_pixels_than_neighbors(method, monkeypatch):
+    img = np.zeros((4, 4, 6), dtype=np.float32)
+    img[0, :3] = np.random.default_rng(0).random((3, 6))
+    scores = []
+    monkeypatch.setattr(outliers.cv2, "merge", lambda channels: scores.append(channels[0]) or np.dstack(channels))
+    # Unmatched neighbors would give inf / inf scores
+    with np.errstate(invalid='raise'):
+        visualization = outliers.get_outlier_image(img, method=method, k=10)
+    assert visualization.shape == (4, 4, 3)
+    assert len(np.unique(scores[0][0, :3])) > 1
+
+
+def test_empty_tissue_mask():
+    img = np.zeros((3, 3, 6), dtype=np.float32)
+    for method in ["nearest", "knn", "graph"]:
+        assert outliers.get_outlier_image(img, method=method).shape == (3, 3, 3)
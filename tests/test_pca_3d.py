@@ -0,0 +1,22 @@
+import numpy as np
+import pytest
+
+from msi_visual.memory import memory_budget
+from msi_visual.pca_3d import PCA3D
+
+
+def test_streaming_merges_small_remainders():
+    rng = np.random.default_rng(0)
+    # One row per chunk, with fewer pixels per row than components
+    images = [rng.random((5, 2, 8)).astype(np.float32)]
+    with memory_budget(1):
+        model = PCA3D(streaming=True)
+        model.fit(images)
+    assert model.pca.n_samples_seen_ == 10
+    assert model.predict(images[0]).shape == (5, 2, 3)
+
+
+def test_streaming_needs_enough_pixels():
+    img = np.ones((1, 2, 8), dtype=np.float32)
+    with pytest.raises(ValueError, match="at least 3 pixels"):
+        PCA3D(streaming=True).fit([img])
@@ -0,0 +1,28 @@
+import numpy as np
+from msi_visual.percentile_ratio import TOP3, top_k_intensities
+
+
+def test_top_k_excludes_background_pixels():
+    rng = np.random.default_rng(0)
+    img = rng.random((6, 7, 20)).astype(np.float32)
+    img[0, 0] = 0
+    # Baseline corrected spectra can be slightly negative outside the tissue
+    img[2, 3] = -rng.random(20) * 1e-3
+    top = top_k_intensities(img, k=3)
+
+    expected = -np.sort(-img, axis=-1)[:, :, :3]
+    expected[0, 0] = 0
+    expected[2, 3] = 0
+    np.testing.assert_array_equal(top, expected)
+
+    visualization = TOP3()(img)
+    assert (visualization[0, 0] == 0).all() and (visualization[2, 3] == 0).all()
+
+
+def test_top_k_uint32_mask():
+    img = np.arange(2 * 3 * 5, dtype=np.uint32).reshape(2, 3, 5)
+    mask = np.ones((2, 3), dtype=bool)
+    mask[1, 2] = False
+    top = top_k_intensities(img, k=2, mask=mask)
+    assert top[1, 2].tolist() == [0, 0]
+    assert top[0, 0].tolist() == [4, 3]
@@ -0,0 +1,13 @@
+import numpy as np
+import pytest
+from msi_visual.preprocessing import preprocess_pixels
+
+
+@pytest.mark.parametrize("start_bin, end_bin", [(0, 14), (3, 5005), (-4, None), (-20, 6), (8, 3)])
+def test_out_of_range_bins_match_slicing(start_bin, end_bin):
+    rng = np.random.default_rng(0)
+    img = rng.random((4, 5, 10)).astype(np.float32)
+    vector, _ = preprocess_pixels(img, start_bin, end_bin)
+    expected = img[:, :, start_bin:end_bin].reshape(4 * 5, -1)
+    assert vector.shape == expected.shape
+    np.testing.assert_array_equal(vector, expected)
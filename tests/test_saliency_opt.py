@@ -0,0 +1,21 @@
+import numpy as np
+import torch
+from msi_visual.saliency_opt import SaliencyOptimization
+from msi_visual.spearman_opt import SpearmanOptimization
+
+
+def small_cube(seed=0):
+    rng = np.random.default_rng(seed)
+    img = rng.random((12, 10, 16)).astype(np.float32)
+    img[0, :3] = 0
+    return img
+
+
+def test_render_does_not_change_the_embedding():
+    for method in [SaliencyOptimization(number_of_points=20, num_epochs=2, device='cpu'),
+                   SpearmanOptimization(number_of_points=20, num_epochs=2, device='cpu')]:
+        method.set_image(small_cube())
+        method.optimize_embeddings()
+        before = method.visualization.detach().clone()
+        method.render()
+        assert torch.equal(method.visualization.detach(), before)
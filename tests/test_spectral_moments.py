@@ -0,0 +1,23 @@
+import numpy as np
+
+from msi_visual.spectral_moments import spectral_moments
+
+
+def test_raw_mean_matches_the_unnormalized_heatmap():
+    img = np.random.default_rng(0).random((6, 5, 40)).astype(np.float32)
+    img[0, 0] = 0
+    mz = np.arange(img.shape[-1])
+    moments = spectral_moments(img)
+    np.testing.assert_allclose(moments["raw_mean"], (img * mz).mean(axis=-1), rtol=1e-4)
+    expected = (img * mz).sum(axis=-1) / np.maximum(img.sum(axis=-1), 1e-12)
+    np.testing.assert_allclose(moments["mean"], expected, rtol=1e-4)
+
+
+def test_entropy_can_be_skipped():
+    img = np.random.default_rng(0).random((4, 4, 20)).astype(np.float32)
+    with_entropy = spectral_moments(img)
+    without_entropy = spectral_moments(img, entropy=False)
+    assert np.all(with_entropy["entropy"] > 0)
+    assert np.all(without_entropy["entropy"] == 0)
+    for name in ["mean", "std", "skewness", "raw_mean"]:
+        np.testing.assert_array_equal(with_entropy[name], without_entropy[name])
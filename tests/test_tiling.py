@@ -0,0 +1,33 @@
+import numpy as np
+from msi_visual.nmf_3d import NMF3D
+from msi_visual.percentile_ratio import TOP3
+from msi_visual.sparse import SparseCube
+from msi_visual.tiling import TileExecutor
+
+
+def sparse_cube_file(tmp_path):
+    rng = np.random.default_rng(0)
+    img = rng.random((12, 9, 40)).astype(np.float32)
+    img[img < 0.8] = 0
+    img[:2] = 0
+    path = str(tmp_path / "0.npz")
+    SparseCube.from_dense(img).save(path)
+    return img, path
+
+
+def test_tile_executor_densifies_tiles_for_dense_methods(tmp_path):
+    img, path = sparse_cube_file(tmp_path)
+    expected = TOP3()(img)
+    np.testing.assert_array_equal(TileExecutor(TOP3(), rows_per_tile=5)(path), expected)
+
+
+def test_tile_executor_keeps_sparse_tiles(tmp_path):
+    img, path = sparse_cube_file(tmp_path)
+    model = NMF3D(max_iter=50)
+    model.fit([img])
+    tiles = []
+    predict_tile = model.predict_tile
+    model.predict_tile = lambda tile: tiles.append(tile) or predict_tile(tile)
+    result = TileExecutor(model, rows_per_tile=5)(path)
+    assert all(isinstance(tile, SparseCube) for tile in tiles)
+    assert np.abs(np.int32(result) - model.predict(img)).max() <= 1